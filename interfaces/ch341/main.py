@@ -8,6 +8,7 @@ class I2C(InterfaceBase):
     AVAILABLE_ARCHITECTURES = [ "i386", "x86_64" ]
     HELP_TEXT = ("OPTIONS: \"-s n\": Set transaction speed\n"
                  "0 = low speed / 20KHz, 1 = standard / 100KHz (default), 2 = fast / 400KHz, 3 = high speed / 750KHz")
+    BUFFER_API = True
 
     _ch341 = None
     _index = -1
@@ -53,14 +54,20 @@ class I2C(InterfaceBase):
             raise ConnectionError
 
     def write_i2c(self, address, data):
-        data.insert(0, address << 1)
-        dat  = (c_ubyte * len(data))(*data)
-        if (not self._ch341.CH341StreamI2C(c_ulong(self._index), c_ulong(len(data)), dat, 0, 0)):
+        dat  = (c_ubyte * (len(data) + 1)).from_buffer_copy(bytes((address << 1,)) + data)
+        if (not self._ch341.CH341StreamI2C(c_ulong(self._index), c_ulong(len(dat)), dat, 0, 0)):
             raise ConnectionError
 
     def read_i2c(self, address, count):
-        dat  = (c_ubyte * count)(*([0] * count))
+        dat  = (c_ubyte * count)()
         if (not self._ch341.CH341StreamI2C(c_ulong(self._index), 1, pointer(c_ulong(address << 1 | 1)), c_ulong(count), dat)):
             raise ConnectionError
-        data = [i for i in dat]
-        return data
+        return bytes(dat)
+
+    def write_read_i2c(self, address, wbuf, rcount):
+        # CH341StreamI2C issues a repeated start with the read address after the write part
+        wdat = (c_ubyte * (len(wbuf) + 1)).from_buffer_copy(bytes((address << 1,)) + wbuf)
+        rdat = (c_ubyte * rcount)()
+        if (not self._ch341.CH341StreamI2C(c_ulong(self._index), c_ulong(len(wbuf) + 1), wdat, c_ulong(rcount), rdat)):
+            raise ConnectionError
+        return bytes(rdat)
@@ -0,0 +1,527 @@
+import os, time, random
+from argparse                  import ArgumentParser
+from interfaces.interface_base import InterfaceBase
+
+class I2C(InterfaceBase):
+    HELP_TEXT = ("Software model of the RTD2660/RTD2662 ISP register file and "
+                 "its SPI flash, for profiling and testing without hardware.\n"
+                 "Busy times of the flash follow a virtual clock which is advanced "
+                 "by the modelled bus time of every transaction and by the time "
+                 "the host spends between transactions.\n"
+                 "OPTIONS:\n"
+                 "  \"-z n\": Set maximum transaction size (default: unlimited)\n"
+                 "  \"-l us\": Set per-transaction latency in microseconds (default: 100)\n"
+                 "  \"-b hz\": Set I2C bus speed in Hz (default: 100000)\n"
+                 "  \"-c hz\": Set SPI clock in Hz (default: 10000000)\n"
+                 "  \"-p us\": Set page program time in microseconds (default: 1400)\n"
+                 "  \"-e ms\": Set chip erase time in milliseconds (default: 2000)\n"
+                 "  \"-k ms\": Set 4 KiB sector erase time in milliseconds (default: 60)\n"
+                 "  \"-K ms\": Set 64 KiB block erase time in milliseconds (default: 700)\n"
+                 "  \"-f n\": Set flash size in bytes (default: 524288)\n"
+                 "  \"-j id\": Set 24-bit JEDEC ID of the flash (default: 0xc22013),\n"
+                 "          SST IDs (0xbfxxxx) model a flash with AAI word programming instead of page program\n"
+                 "  \"-i file\": Load flash image from file and store it back on deinit\n"
+                 "  \"-r\": Sleep for the modelled bus time instead of only accounting it\n"
+                 "  \"-F rate\": Fail this fraction of transactions after a random part of them (default: 0)\n"
+                 "  \"-x seed\": Seed of the failure injection (default: 0)\n"
+                 "  \"-q\": Model a basic backend without repeated start, native block transfers and batching\n"
+                 "  \"-L\": Model a plugin passing data as lists of ints instead of the buffer API")
+
+    MAXIMUM_READ_AMOUNT  = 0
+    MAXIMUM_WRITE_AMOUNT = 0
+    MAXIMUM_BATCH_AMOUNT = 0
+    BUFFER_API           = True
+
+    _RTD_ISP_ADR         = 0x4A
+    _RTD_ISP_AUTOINC_ADR = 0x4B
+
+    _FLASH_PAGE_SIZE   = 256 # SPI flash page, programming wraps around inside of it
+    _ISP_BUFFER_SIZE   = 256 # Size of the controller's programming buffer behind 0x70
+    _WRSR_TIME         = 0.005
+    _AAI_WORD_TIME     = 10e-6
+    _SST_MANUFACTURER  = 0xBF
+
+    # SPI flash opcodes understood by the model
+    _SPI_WREN  = 0x06
+    _SPI_WRDI  = 0x04
+    _SPI_RDSR  = 0x05
+    _SPI_EWSR  = 0x50
+    _SPI_WRSR  = 0x01
+    _SPI_READ  = 0x03
+    _SPI_FAST_READ = 0x0B
+    _SPI_PRGM  = 0x02
+    _SPI_AAI   = 0xAD
+    _SPI_RDID  = 0x9F
+    _SPI_CHIP_ERASE = ( 0x60, 0xC7 )
+    _SPI_SECTOR_ERASE = 0x20 # 4 KiB
+    _SPI_BLOCK_ERASE  = 0xD8 # 64 KiB
+
+    # Custom instruction types (register 0x60 bits 7..5)
+    _CI_NOP   = 0
+    _CI_WRITE = 1
+    _CI_READ  = 2
+    _CI_WRITE_AFTER_WREN = 3
+    _CI_WRITE_AFTER_EWSR = 4
+    _CI_ERASE = 5
+
+    # Register 0x6F bits
+    _ISP_EN     = 0x80
+    _PRGM_BUSY  = 0x40
+    _PRGM_START = 0x20
+    _CRC_START  = 0x04
+    _CRC_DONE   = 0x02
+
+
+    def __init__(self):
+        self._flash = None
+        self._image = None
+        self._set_defaults()
+        self.reset_stats()
+
+    def _set_defaults(self):
+        self.MAXIMUM_READ_AMOUNT  = I2C.MAXIMUM_READ_AMOUNT
+        self.MAXIMUM_WRITE_AMOUNT = I2C.MAXIMUM_WRITE_AMOUNT
+        self.MAXIMUM_BATCH_AMOUNT = I2C.MAXIMUM_BATCH_AMOUNT
+        self.BUFFER_API           = I2C.BUFFER_API
+        self._latency     = 100e-6
+        self._bus_speed   = 100000
+        self._spi_speed   = 10000000
+        self._page_time   = 1400e-6
+        self._chip_erase_time   = 2.0
+        self._sector_erase_time = 0.060
+        self._block_erase_time  = 0.700
+        self._flash_size  = 512 * 2**10
+        self._jedec_id    = 0xC22013
+        self._realtime    = False
+        self._basic       = False
+        self._fault_rate  = 0.0
+        self._fault_seed  = 0
+
+    def reset_stats(self):
+        """ Zero transaction counters """
+        self.stats = {
+            "calls":         0, # Number of calls into the interface, each pays the latency once
+            "transactions":  0, # Number of I2C transactions (a combined write-read counts once)
+            "bytes_written": 0, # Payload bytes sent to the device
+            "bytes_read":    0, # Payload bytes received from the device
+            "bus_time":      0.0, # Modelled time spent on the bus, in seconds
+            "faults":        0, # Injected transaction failures
+            "dropped":       0, # Commands ignored because the flash was still busy
+        }
+
+
+    # Virtual clock
+
+    def _now(self):
+        if self._realtime:
+            return time.perf_counter()
+        # Time the host spent between transactions passes for the flash too
+        return self._clock + (time.perf_counter() - self._mark)
+
+    def _transaction(self, written, read, new_call=True):
+        """ Account for one bus transaction with given payload sizes """
+        bits  = 9 * (1 + written) if written or not read else 0 # Address byte + data, each with an ACK bit
+        bits += 9 * (1 + read)    if read else 0
+        cost  = (bits + 2) / self._bus_speed # + START and STOP
+        if new_call:
+            cost += self._latency
+            self.stats["calls"] += 1
+        self.stats["transactions"]  += 1
+        self.stats["bytes_written"] += written
+        self.stats["bytes_read"]    += read
+        self.stats["bus_time"]      += cost
+        if self._realtime:
+            time.sleep(cost)
+        else:
+            self._clock = self._now() + cost
+            self._mark  = time.perf_counter()
+
+
+    # Controller register file
+
+    def _reset_controller(self):
+        self._regs   = bytearray(256)
+        self._ptr    = 0
+        self._buffer = bytearray()
+        self._ci_done   = 0.0 # Time at which the custom instruction engine is idle again
+        self._prgm_done = 0.0 # Time at which the page program engine is idle again
+        self._crc_done  = None
+        self._crc       = 0x00
+        self._stream    = None # Flash address the 0x70 port reads from, None if no read was issued
+        self._stream_skip = 0
+
+    def _write_register(self, reg, value):
+        if reg == 0x60:
+            self._regs[0x60] = value & 0xFE
+            if value & 0x01 and self._regs[0x6F] & self._ISP_EN:
+                self._custom_instruction(value)
+        elif reg == 0x6F:
+            self._regs[0x6F] = value & self._ISP_EN
+            if not value & self._ISP_EN:
+                return
+            if not value & (self._PRGM_START | self._CRC_START):
+                self._buffer = bytearray() # Entering ISP mode restarts the programming buffer
+            if value & self._PRGM_START:
+                self._program()
+            if value & self._CRC_START:
+                self._start_crc()
+        elif reg == 0x70:
+            if len(self._buffer) < self._ISP_BUFFER_SIZE:
+                self._buffer.append(value)
+        elif reg == 0xEE:
+            if value & 0x02: # Reboot the MCU, which also leaves ISP mode
+                self._reset_controller()
+        else:
+            self._regs[reg] = value
+
+    def _read_register(self, reg):
+        now = self._now()
+        if reg == 0x60:
+            return self._regs[0x60] | (1 if now < self._ci_done else 0)
+        elif reg == 0x6F:
+            value = self._regs[0x6F]
+            if now < self._prgm_done:
+                value |= self._PRGM_BUSY
+            if self._crc_done is not None and now >= self._crc_done:
+                value |= self._CRC_DONE
+            return value
+        elif reg == 0x70:
+            if self._stream is None:
+                return 0xFF
+            if self._stream_skip: # Dummy cycles of fast read opcodes
+                self._stream_skip -= 1
+                return 0xFF
+            value = self._flash[self._stream]
+            self._stream = (self._stream + 1) % len(self._flash)
+            return value
+        elif reg == 0x75:
+            return self._crc
+        return self._regs[reg]
+
+
+    # Engines
+
+    def _address(self, reg):
+        return (self._regs[reg] << 16) | (self._regs[reg+1] << 8) | self._regs[reg+2]
+
+    def _custom_instruction(self, value):
+        cmd_type =  value >> 5
+        write_n  = (value >> 3) & 3
+        read_n   = (value >> 1) & 3
+        opcode   = self._regs[0x61]
+        operands = bytes(self._regs[0x64:0x64+write_n])
+        start    = self._now()
+        duration = (1 + write_n + read_n) * 8 / self._spi_speed
+        # A busy flash ignores everything but reading its status
+        if self._busy(start) and not (cmd_type == self._CI_READ and opcode == self._SPI_RDSR):
+            self.stats["dropped"] += 1
+            return
+
+        if cmd_type == self._CI_READ:
+            result = self._spi_read(opcode, operands, read_n)
+            self._regs[0x67:0x67+read_n] = result
+            if opcode in (self._SPI_READ, self._SPI_FAST_READ) and write_n == 3:
+                self._stream = int.from_bytes(operands, "big") % len(self._flash)
+                self._stream_skip = 1 if opcode == self._SPI_FAST_READ else 0
+        elif cmd_type == self._CI_WRITE:
+            duration += self._spi_write(opcode, operands)
+        elif cmd_type == self._CI_WRITE_AFTER_WREN:
+            self._spi_write(self._regs[0x62], b"")
+            duration += self._spi_write(opcode, operands)
+        elif cmd_type == self._CI_WRITE_AFTER_EWSR:
+            self._spi_write(self._regs[0x63], b"")
+            duration += self._spi_write(opcode, operands)
+        elif cmd_type == self._CI_ERASE:
+            self._spi_write(self._regs[0x62], b"")
+            duration += self._spi_write(opcode, operands)
+        self._ci_done = max(self._ci_done, start + duration) # Reading the status doesn't end a busy period
+
+    def _busy(self, now):
+        """ Test if the flash or the custom instruction engine is still busy at time 'now' """
+        return now < self._ci_done or now < self._prgm_done
+
+    def _spi_read(self, opcode, operands, count):
+        if opcode == self._SPI_RDID:
+            data = self._jedec_id.to_bytes(3, "big")
+        elif opcode == self._SPI_RDSR:
+            data = bytes([self._status | (0x02 if self._wel else 0x00)] * 3)
+        elif opcode in (self._SPI_READ, self._SPI_FAST_READ) and len(operands) == 3:
+            address = int.from_bytes(operands, "big")
+            if opcode == self._SPI_FAST_READ:
+                data = b"\xFF" + self._flash_read(address, count - 1)
+            else:
+                data = self._flash_read(address, count)
+        else:
+            data = b"\xFF" * 3
+        return data[:count]
+
+    def _spi_write(self, opcode, operands):
+        """ Execute a write type SPI command, return the time the flash stays busy """
+        if opcode == self._SPI_WREN:
+            self._wel = True
+        elif opcode == self._SPI_WRDI:
+            self._wel = False
+            self._aai = None
+        elif opcode == self._SPI_AAI and self._aai is not None and len(operands) == 2:
+            self._program_bytes(self._aai, operands)
+            self._aai = (self._aai + 2) % len(self._flash)
+            return self._AAI_WORD_TIME
+        elif opcode == self._SPI_EWSR:
+            self._ewsr = True
+        elif opcode == self._SPI_WRSR and operands:
+            if self._wel or self._ewsr:
+                self._status = operands[0] & 0x9C # Block protect and status register protect bits
+                self._wel = self._ewsr = False
+                return self._WRSR_TIME
+        elif opcode in self._SPI_CHIP_ERASE:
+            return self._erase(0, len(self._flash), self._chip_erase_time)
+        elif opcode == self._SPI_SECTOR_ERASE and len(operands) == 3:
+            return self._erase(int.from_bytes(operands, "big") & ~0xFFF, 0x1000, self._sector_erase_time)
+        elif opcode == self._SPI_BLOCK_ERASE and len(operands) == 3:
+            return self._erase(int.from_bytes(operands, "big") & ~0xFFFF, 0x10000, self._block_erase_time)
+        return 0.0
+
+    def _erase(self, address, size, duration):
+        if not self._wel:
+            return 0.0
+        self._wel = False
+        if self._status & 0x1C: # Any block protection is treated as whole chip protection
+            return 0.0
+        address %= len(self._flash)
+        self._flash[address:address+size] = b"\xFF" * min(size, len(self._flash) - address)
+        return duration
+
+    def _program(self):
+        """ Start the page program engine with the content of the 0x70 buffer """
+        start   = self._now()
+        data    = self._buffer[:self._regs[0x71] + 1]
+        address = self._address(0x64) % len(self._flash)
+        self._buffer = bytearray()
+        if self._busy(start): # Program command of the engine is ignored by the busy flash
+            self.stats["dropped"] += 1
+            return
+        if self._status & 0x1C:
+            return
+        # Address and data are latched here
+        if self._is_sst():
+            # The first word of an AAI sequence, the following ones are custom instructions
+            if self._regs[0x6D] != self._SPI_AAI or len(data) != 2:
+                return
+            self._program_bytes(address & ~1, data)
+            self._aai = (address + 2) % len(self._flash)
+            self._prgm_done = start + self._AAI_WORD_TIME + 48 * 8 / self._spi_speed
+            return
+        if self._regs[0x6D] != self._SPI_PRGM:
+            return
+        # Bits can only be cleared; addresses wrap inside the flash page
+        page = address & ~(self._FLASH_PAGE_SIZE - 1)
+        for offset, value in enumerate(data):
+            target = page | ((address + offset) & (self._FLASH_PAGE_SIZE - 1))
+            self._flash[target] &= value
+        self._prgm_done = start + self._page_time * len(data) / self._FLASH_PAGE_SIZE + 32 * 8 / self._spi_speed
+
+    def _is_sst(self):
+        """ SST flashes have no page program, only Auto Address Increment programming """
+        return self._jedec_id >> 16 == self._SST_MANUFACTURER
+
+    def _program_bytes(self, address, data):
+        for offset, value in enumerate(data):
+            self._flash[(address + offset) % len(self._flash)] &= value
+
+    def _start_crc(self):
+        start = max(self._now(), self._ci_done, self._prgm_done)
+        begin = self._address(0x64) % len(self._flash)
+        end   = self._address(0x72) % len(self._flash)
+        crc   = 0x00
+        for byte in self._flash[begin:end+1]:
+            crc ^= byte
+            for _ in range(8):
+                crc = ((crc << 1) ^ 0x07 if crc & 0x80 else crc << 1) & 0xFF
+        self._crc      = crc
+        self._crc_done = start + (end - begin + 1) * 8 / self._spi_speed
+
+    def _flash_read(self, address, count):
+        address %= len(self._flash)
+        return bytes(self._flash[(address + i) % len(self._flash)] for i in range(count))
+
+
+    # Interface
+
+    def list_i2c(self):
+        return { 0: "Emulated RTD2660" }
+
+    def init_i2c(self, device, settings):
+        if device != 0:
+            raise ConnectionError(f"No emulated device {device}")
+        self._set_defaults()
+        image = None
+        if settings is not None:
+            parser = ArgumentParser(add_help=False)
+            parser.add_argument('-z', type=int,   dest="exch_size")
+            parser.add_argument('-l', type=float, dest="latency")
+            parser.add_argument('-b', type=float, dest="bus_speed")
+            parser.add_argument('-c', type=float, dest="spi_speed")
+            parser.add_argument('-p', type=float, dest="page_time")
+            parser.add_argument('-e', type=float, dest="chip_erase_time")
+            parser.add_argument('-k', type=float, dest="sector_erase_time")
+            parser.add_argument('-K', type=float, dest="block_erase_time")
+            parser.add_argument('-f', type=lambda s: int(s, 0), dest="flash_size")
+            parser.add_argument('-j', type=lambda s: int(s, 0), dest="jedec_id")
+            parser.add_argument('-i', type=str,   dest="image")
+            parser.add_argument('-r', action="store_true", dest="realtime")
+            parser.add_argument('-q', action="store_true", dest="basic")
+            parser.add_argument('-L', action="store_true", dest="list_api")
+            parser.add_argument('-F', type=float, dest="fault_rate")
+            parser.add_argument('-x', type=int,   dest="fault_seed")
+            args = parser.parse_args(settings.split())
+            if args.exch_size is not None:
+                self.MAXIMUM_READ_AMOUNT  = args.exch_size
+                self.MAXIMUM_WRITE_AMOUNT = args.exch_size
+            if args.latency is not None:
+                self._latency = args.latency * 1e-6
+            if args.bus_speed is not None:
+                self._bus_speed = args.bus_speed
+            if args.spi_speed is not None:
+                self._spi_speed = args.spi_speed
+            if args.page_time is not None:
+                self._page_time = args.page_time * 1e-6
+            if args.chip_erase_time is not None:
+                self._chip_erase_time = args.chip_erase_time * 1e-3
+            if args.sector_erase_time is not None:
+                self._sector_erase_time = args.sector_erase_time * 1e-3
+            if args.block_erase_time is not None:
+                self._block_erase_time = args.block_erase_time * 1e-3
+            if args.flash_size is not None:
+                self._flash_size = args.flash_size
+            if args.jedec_id is not None:
+                self._jedec_id = args.jedec_id
+            if args.fault_rate is not None:
+                self._fault_rate = args.fault_rate
+            if args.fault_seed is not None:
+                self._fault_seed = args.fault_seed
+            self._realtime = args.realtime
+            self._basic    = args.basic
+            if self._basic:
+                self.MAXIMUM_BATCH_AMOUNT = 1
+            if args.list_api:
+                self.BUFFER_API = False
+            image = args.image
+
+        # Flash content survives reinitialization, like a real board does
+        if self._flash is None or len(self._flash) != self._flash_size or image != self._image:
+            self._flash = bytearray(b"\xFF" * self._flash_size)
+            if image is not None and os.path.exists(image):
+                with open(image, "rb") as fimg:
+                    content = fimg.read(self._flash_size)
+                self._flash[:len(content)] = content
+            self._status = 0x1C
+        self._image = image
+        self._wel  = False
+        self._ewsr = False
+        self._aai  = None # Next address of a running AAI sequence
+        self._clock = 0.0
+        self._mark  = time.perf_counter()
+        self._faults = random.Random(self._fault_seed)
+        self._reset_controller()
+
+    def deinit_i2c(self):
+        if self._image is not None:
+            with open(self._image, "wb") as fimg:
+                fimg.write(self._flash)
+
+    def detect_i2c(self, address):
+        return address in (self._RTD_ISP_ADR, self._RTD_ISP_AUTOINC_ADR)
+
+    def write_i2c(self, address, data):
+        if not self.detect_i2c(address):
+            raise ConnectionError("No ACK from device")
+        self._transaction(len(data), 0)
+        self._write(address, data)
+
+    def read_i2c(self, address, count):
+        if not self.detect_i2c(address):
+            raise ConnectionError("No ACK from device")
+        self._transaction(0, count)
+        return self._read(address, count)
+
+    def write_read_i2c(self, address, wbuf, rcount):
+        if self._basic:
+            return super().write_read_i2c(address, wbuf, rcount)
+        if not self.detect_i2c(address):
+            raise ConnectionError("No ACK from device")
+        self._transaction(len(wbuf), rcount) # Repeated start, single transaction
+        self._write(address, wbuf)
+        return self._read(address, rcount)
+
+    def read_block(self, address, reg, count, sticky=False):
+        if self._basic:
+            return super().read_block(address, reg, count, sticky)
+        if not self.detect_i2c(address):
+            raise ConnectionError("No ACK from device")
+        # One call into the interface, the bus still sees one transaction per chunk
+        bytes_per_trans = self.MAXIMUM_READ_AMOUNT if self.MAXIMUM_READ_AMOUNT else max(count, 1)
+        chunks = []
+        for byte_n in range(0, count, bytes_per_trans):
+            chunk = min(count - byte_n, bytes_per_trans)
+            if reg is None or (sticky and byte_n):
+                self._transaction(0, chunk, byte_n == 0)
+            else:
+                self._transaction(1, chunk, byte_n == 0)
+                self._write(address, (reg,))
+            chunks.append(self._read(address, chunk))
+        return self._join(chunks)
+
+    def write_block(self, address, reg, data):
+        if self._basic:
+            return super().write_block(address, reg, data)
+        if not self.detect_i2c(address):
+            raise ConnectionError("No ACK from device")
+        bytes_per_trans = self.MAXIMUM_WRITE_AMOUNT - 1 if self.MAXIMUM_WRITE_AMOUNT else max(len(data), 1)
+        for byte_n in range(0, max(len(data), 1), bytes_per_trans):
+            chunk = self._with_reg(reg, data[byte_n:byte_n+bytes_per_trans])
+            self._transaction(len(chunk), 0, byte_n == 0)
+            self._write(address, chunk)
+
+    def transfer_i2c(self, messages):
+        if self._basic:
+            return super().transfer_i2c(messages)
+        results = []
+        for msg_n, (address, wbuf, rcount) in enumerate(messages):
+            if not self.detect_i2c(address):
+                raise ConnectionError("No ACK from device")
+            self._transaction(len(wbuf), rcount, msg_n == 0)
+            self._write(address, wbuf)
+            if rcount:
+                results.append(self._read(address, rcount))
+        return results
+
+    def _fault_point(self, count):
+        """ Number of the 'count' bytes of a transaction which get through before an injected failure,
+            None if it doesn't fail """
+        if self._fault_rate and self._faults.random() < self._fault_rate:
+            self.stats["faults"] += 1
+            return self._faults.randrange(count + 1)
+        return None
+
+    def _write(self, address, data):
+        if len(data) == 0:
+            return
+        fault = self._fault_point(len(data))
+        self._ptr = data[0]
+        for value in data[1:fault]:
+            self._write_register(self._ptr, value & 0xFF)
+            if address == self._RTD_ISP_AUTOINC_ADR:
+                self._ptr = (self._ptr + 1) & 0xFF
+        if fault is not None:
+            raise ConnectionError("Emulated transfer failure")
+
+    def _read(self, address, count):
+        fault = self._fault_point(count)
+        data  = bytearray() if self.BUFFER_API else []
+        for _ in range(count if fault is None else fault):
+            data.append(self._read_register(self._ptr))
+            if address == self._RTD_ISP_AUTOINC_ADR:
+                self._ptr = (self._ptr + 1) & 0xFF
+        if fault is not None:
+            raise ConnectionError("Emulated transfer failure")
+        return bytes(data) if self.BUFFER_API else data
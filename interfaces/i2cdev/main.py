@@ -1,5 +1,6 @@
-import posix, os, re, time
+import posix, os, re, time, json
 from argparse                  import ArgumentParser
+from ctypes                    import *
 from fcntl                     import ioctl
 from interfaces.interface_base import InterfaceBase
 
@@ -7,15 +8,86 @@ from interfaces.interface_base import InterfaceBase
 class I2C(InterfaceBase):
     HELP_TEXT = ("i2c-dev is a Linux module for accessing I2C master devices "
                  "from userspace, via the /dev interface.\n"
-                 "OPTIONS: \"-z n\": Set maximum transaction size")
+                 "By default the largest reliable read and write sizes are probed once per adapter, "
+                 "after the controller was found, and cached by the adapter name. Adapters without "
+                 "plain I2C support are driven through SMBus I2C-block transfers of up to 32 bytes.\n"
+                 "OPTIONS: \"-z n\": Set maximum transaction size\n"
+                 "         \"-p\": Probe transaction sizes again instead of using the cached ones\n"
+                 "         \"-n\": Don't combine transactions with I2C_RDWR, use plain read/write calls")
     AVAILABLE_SYSTEMS = [ "Linux" ]
     MAXIMUM_READ_AMOUNT = 16
     MAXIMUM_WRITE_AMOUNT = 16
+    MAXIMUM_BATCH_AMOUNT = 0 # Split into I2C_RDWR calls of at most _I2C_RDWR_MAX_MSGS messages internally
+    BUFFER_API = True
 
     _fi2c = None
+    _slave = None # Address last set with I2C_SLAVE
+    _rdwr = True  # Use I2C_RDWR for compound transactions
+    _funcs = 0    # Adapter functionality reported by I2C_FUNCS
+    _smbus = False # Use SMBus transfers, adapter can't do plain I2C
+    _smbus_reg = None # Last command byte sent, which is where the register pointer of the device is
+    _device  = None  # Number of the opened adapter
+    _probe   = False # Transaction sizes are neither set nor cached, probe them in tune_i2c
 
     _I2C_SLAVE = 0x0703 # Set I2C slave address ioctl call
+    _I2C_FUNCS = 0x0705 # Get the adapter functionality mask ioctl call
+    _I2C_SMBUS = 0x0720 # SMBus transfer ioctl call
+    _I2C_RDWR  = 0x0707 # Combined R/W transfer (one STOP only) ioctl call
+    _I2C_M_RD  = 0x0001 # Read flag of i2c_msg
+    _I2C_RDWR_MAX_MSGS = 42 # Kernel limit of messages in one I2C_RDWR call
 
+    _I2C_FUNC_I2C = 0x00000001 # Plain I2C transactions (read/write and I2C_RDWR) are supported
+    _I2C_FUNC_SMBUS_QUICK           = 0x00010000
+    _I2C_FUNC_SMBUS_READ_I2C_BLOCK  = 0x04000000
+    _I2C_FUNC_SMBUS_WRITE_I2C_BLOCK = 0x08000000
+
+    _I2C_SMBUS_WRITE = 0
+    _I2C_SMBUS_READ  = 1
+    _I2C_SMBUS_QUICK          = 0
+    _I2C_SMBUS_BYTE           = 1 # Send/receive byte, no command
+    _I2C_SMBUS_BYTE_DATA      = 2
+    _I2C_SMBUS_I2C_BLOCK_DATA = 8 # Command byte followed by up to 32 raw bytes, no length byte on the bus
+    _I2C_SMBUS_BLOCK_MAX      = 32
+
+    # Read size probing is done by repeatedly reading a status register of the controller,
+    # reading a non auto-incrementing register has no side effects and has to return the same byte every time.
+    # Write size probing fills the CRC end address register, which is harmless until a CRC is started,
+    # only the last byte written stays in a non auto-incrementing register.
+    _PROBE_REG       = 0x6F
+    _PROBE_WRITE_REG = 0x72
+    _PROBE_SIZES = [ 256, 128, 64, 32, 16, 8 ]
+    _CACHE_FILE  = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")),
+                                "rtdmultiprog", "i2cdev.json")
+
+    class _I2cMsg(Structure):
+        _fields_ = [("addr",  c_uint16),
+                    ("flags", c_uint16),
+                    ("len",   c_uint16),
+                    ("buf",   POINTER(c_uint8))]
+
+    class _I2cRdwrData(Structure):
+        _fields_ = [("msgs",  c_void_p), # struct i2c_msg *
+                    ("nmsgs", c_uint32)]
+
+    class _I2cSmbusData(Union):
+        _fields_ = [("byte",  c_uint8),
+                    ("word",  c_uint16),
+                    ("block", c_uint8 * 34)] # Length byte, 32 data bytes and PEC
+
+    class _I2cSmbusIoctlData(Structure):
+        _fields_ = [("read_write", c_uint8),
+                    ("command",    c_uint8),
+                    ("size",       c_uint32),
+                    ("data",       c_void_p)] # union i2c_smbus_data *
+
+
+    def __init__(self):
+        # Buffers reused by every I2C_RDWR call
+        self._msgs = (self._I2cMsg * self._I2C_RDWR_MAX_MSGS)()
+        self._rdwr_data = self._I2cRdwrData(addressof(self._msgs), 0)
+        self._pool = (c_uint8 * 4096)()
+        self._smbus_data = self._I2cSmbusData()
+        self._smbus_args = self._I2cSmbusIoctlData(0, 0, 0, addressof(self._smbus_data))
 
     def list_i2c(self):
         try:
@@ -24,7 +96,7 @@ class I2C(InterfaceBase):
             raise FileNotFoundError("I2C device directory not found")
         dev_dict = {}
         for dev in dev_list:
-            match = re.match("i2c-\d+", dev)
+            match = re.match("i2c-\d+", dev)
             if match:
                 num = int(re.sub("i2c-", "", dev))
                 with open("/sys/bus/i2c/devices/"+match.string+"/name", 'r') as fname:
@@ -34,33 +106,270 @@ class I2C(InterfaceBase):
 
     def init_i2c(self, device, settings):
         self._fi2c = posix.open("/dev/i2c-"+str(device), posix.O_RDWR)
+        self._slave = None
+        self._device = device
+        self._probe  = False
+        # Defaults, the same object is initialized again for every listed adapter
+        self._rdwr  = True
+        self._smbus = False
+        self.MAXIMUM_READ_AMOUNT  = I2C.MAXIMUM_READ_AMOUNT
+        self.MAXIMUM_WRITE_AMOUNT = I2C.MAXIMUM_WRITE_AMOUNT
+        self.MAXIMUM_BATCH_AMOUNT = I2C.MAXIMUM_BATCH_AMOUNT
+        funcs = c_ulong()
+        ioctl(self._fi2c, self._I2C_FUNCS, funcs)
+        self._funcs = funcs.value
+        if not self._funcs & self._I2C_FUNC_I2C:
+            self._rdwr = False
+            self.MAXIMUM_BATCH_AMOUNT = 1
+            block_funcs = self._I2C_FUNC_SMBUS_READ_I2C_BLOCK | self._I2C_FUNC_SMBUS_WRITE_I2C_BLOCK
+            self._smbus = self._funcs & block_funcs == block_funcs
         # Set exchange size
+        exch_size = None
+        reprobe   = False
         if settings is not None:
             parser = ArgumentParser(add_help=False)
             parser.add_argument('-z', type=int, dest="exch_size")
+            parser.add_argument('-p', action="store_true", dest="reprobe")
+            parser.add_argument('-n', action="store_true", dest="no_rdwr")
             args = parser.parse_args(settings.split())
-            if args.exch_size is not None:
-                self.MAXIMUM_READ_AMOUNT  = args.exch_size
-                self.MAXIMUM_WRITE_AMOUNT = args.exch_size
+            exch_size = args.exch_size
+            reprobe   = args.reprobe
+            if args.no_rdwr:
+                self._rdwr = False
+                self.MAXIMUM_BATCH_AMOUNT = 1
+        if self._smbus: # Fixed by the SMBus block size, the register is sent as the command byte
+            self.MAXIMUM_READ_AMOUNT  = min(exch_size or self._I2C_SMBUS_BLOCK_MAX, self._I2C_SMBUS_BLOCK_MAX)
+            self.MAXIMUM_WRITE_AMOUNT = min(exch_size or self._I2C_SMBUS_BLOCK_MAX + 1, self._I2C_SMBUS_BLOCK_MAX + 1)
+            return
+        if exch_size is not None:
+            self.MAXIMUM_READ_AMOUNT  = exch_size
+            self.MAXIMUM_WRITE_AMOUNT = exch_size
+            return
+        sizes = None if reprobe else self._load_transfer_sizes().get(self._adapter_name())
+        if isinstance(sizes, dict):
+            self.MAXIMUM_READ_AMOUNT  = sizes["read"]
+            self.MAXIMUM_WRITE_AMOUNT = sizes["write"]
+        else: # The controller may not be on this bus, sizes are only probed once it was found
+            self._probe = True
 
     def deinit_i2c(self):
         posix.close(self._fi2c)
 
-    def detect_i2c(self, address):
+    def tune_i2c(self, address):
+        """ Probe the transaction sizes against the found controller and cache them by the adapter name """
+        if not self._probe:
+            return
+        self._probe = False
+        read_size  = self._probe_read_size(address)
+        write_size = self._probe_write_size(address)
+        if read_size is None or write_size is None: # Keep the defaults
+            return
+        self.MAXIMUM_READ_AMOUNT  = read_size
+        self.MAXIMUM_WRITE_AMOUNT = write_size
+        name = self._adapter_name()
+        if name is None:
+            return
+        cache = self._load_transfer_sizes()
+        cache[name] = { "read": read_size, "write": write_size }
         try:
+            os.makedirs(os.path.dirname(self._CACHE_FILE), exist_ok=True)
+            with open(self._CACHE_FILE, 'w') as fcache:
+                json.dump(cache, fcache, indent=2)
+        except OSError:
+            pass # Cache is only an optimization
+
+    def _adapter_name(self):
+        try:
+            with open(f"/sys/bus/i2c/devices/i2c-{self._device}/name", 'r') as fname:
+                return fname.readline().strip()
+        except OSError:
+            return None
+
+    def _load_transfer_sizes(self):
+        """ Cached transaction sizes {adapter_name: {"read": n, "write": n}, ...} """
+        try:
+            with open(self._CACHE_FILE, 'r') as fcache:
+                return json.load(fcache)
+        except (OSError, ValueError):
+            return {}
+
+    def _probe_read_size(self, address):
+        """ Return largest read size giving consistent results, None if the controller doesn't respond """
+        try:
+            expected = self.write_read_i2c(address, bytes((self._PROBE_REG,)), 1)
+        except (ConnectionError, OSError):
+            return None
+        for size in self._PROBE_SIZES:
+            try:
+                if all(self.write_read_i2c(address, bytes((self._PROBE_REG,)), size) == expected * size
+                       for _ in range(2)):
+                    return size
+            except (ConnectionError, OSError):
+                pass
+        return None
+
+    def _probe_write_size(self, address):
+        """ Return largest write size whose last byte arrives, None if no size works """
+        for size in self._PROBE_SIZES:
+            try:
+                if all(self._probe_write(address, size, value) for value in (0xA5, 0x5A)):
+                    return size
+            except (ConnectionError, OSError):
+                pass
+        return None
+
+    def _probe_write(self, address, size, value):
+        """ Write transaction of 'size' bytes ending with 'value' into the probe register, test if it got there """
+        self.write_i2c(address, bytes((self._PROBE_WRITE_REG,)) + bytes((value ^ 0xFF,)) * (size - 2) + bytes((value,)))
+        return self.write_read_i2c(address, bytes((self._PROBE_WRITE_REG,)), 1) == bytes((value,))
+
+    def _set_slave(self, address):
+        if address != self._slave:
             ioctl(self._fi2c, self._I2C_SLAVE, address)
+            self._slave = address
+
+    def _rdwr_call(self, msgs):
+        """ Execute [(address, is_read, offset, length), ...] with buffers in the pool """
+        for msg_n, (address, is_read, offset, length) in enumerate(msgs):
+            msg = self._msgs[msg_n]
+            msg.addr  = address
+            msg.flags = self._I2C_M_RD if is_read else 0
+            msg.len   = length
+            msg.buf   = cast(byref(self._pool, offset), POINTER(c_uint8))
+        self._rdwr_data.nmsgs = len(msgs)
+        try:
+            ioctl(self._fi2c, self._I2C_RDWR, addressof(self._rdwr_data))
+        except OSError:
+            raise ConnectionError("No ACK from device")
+
+    def _smbus_call(self, read_write, command, size):
+        """ Execute SMBus transfer with the data in _smbus_data """
+        self._smbus_args.read_write = read_write
+        self._smbus_args.command    = command
+        self._smbus_args.size       = size
+        try:
+            ioctl(self._fi2c, self._I2C_SMBUS, addressof(self._smbus_args))
+        except OSError:
+            raise ConnectionError("No ACK from device")
+
+    def _smbus_write(self, address, data):
+        self._set_slave(address)
+        self._smbus_reg = data[0] if data else self._smbus_reg
+        if len(data) == 0:
+            self._smbus_call(self._I2C_SMBUS_WRITE, 0, self._I2C_SMBUS_QUICK)
+        elif len(data) == 1: # Send byte
+            self._smbus_call(self._I2C_SMBUS_WRITE, data[0], self._I2C_SMBUS_BYTE)
+        elif len(data) == 2:
+            self._smbus_data.byte = data[1]
+            self._smbus_call(self._I2C_SMBUS_WRITE, data[0], self._I2C_SMBUS_BYTE_DATA)
+        elif len(data) - 1 <= self._I2C_SMBUS_BLOCK_MAX:
+            self._smbus_data.block[0] = len(data) - 1
+            self._smbus_data.block[1:len(data)] = data[1:]
+            self._smbus_call(self._I2C_SMBUS_WRITE, data[0], self._I2C_SMBUS_I2C_BLOCK_DATA)
+        else:
+            raise ConnectionError(f"SMBus can't write {len(data)} bytes in one transaction")
+
+    def _smbus_read(self, address, command, count):
+        self._set_slave(address)
+        self._smbus_reg = command if command is not None else self._smbus_reg
+        if command is None: # Receive byte, one transaction per byte
+            data = bytearray()
+            for _ in range(count):
+                self._smbus_call(self._I2C_SMBUS_READ, 0, self._I2C_SMBUS_BYTE)
+                data.append(self._smbus_data.byte)
+            return bytes(data)
+        if count == 1:
+            self._smbus_call(self._I2C_SMBUS_READ, command, self._I2C_SMBUS_BYTE_DATA)
+            return bytes((self._smbus_data.byte,))
+        if count > self._I2C_SMBUS_BLOCK_MAX:
+            raise ConnectionError(f"SMBus can't read {count} bytes in one transaction")
+        self._smbus_data.block[0] = count
+        self._smbus_call(self._I2C_SMBUS_READ, command, self._I2C_SMBUS_I2C_BLOCK_DATA)
+        return bytes(self._smbus_data.block[1:1+count])
+
+    def _reserve(self, size):
+        if size > len(self._pool):
+            self._pool = (c_uint8 * size)()
+
+    def detect_i2c(self, address):
+        try:
+            if self._smbus:
+                if self._funcs & self._I2C_FUNC_SMBUS_QUICK:
+                    self._smbus_write(address, b"")
+                else:
+                    self._smbus_read(address, None, 1)
+                return True
+            self._set_slave(address)
             posix.write(self._fi2c, bytes(0))
             return True
         except Exception:
             return False
 
     def write_i2c(self, address, data):
-        ioctl(self._fi2c, self._I2C_SLAVE, address)
+        if self._smbus:
+            return self._smbus_write(address, data)
+        self._set_slave(address)
         try:
-            posix.write(self._fi2c, bytes(data))
+            posix.write(self._fi2c, data)
         except IOError:
             raise ConnectionError("No ACK from device")
 
     def read_i2c(self, address, count):
-        ioctl(self._fi2c, self._I2C_SLAVE, address)
-        return list(posix.read(self._fi2c, count))
+        if self._smbus:
+            return self._smbus_read(address, None, count)
+        self._set_slave(address)
+        try:
+            return posix.read(self._fi2c, count)
+        except IOError:
+            raise ConnectionError("No ACK from device")
+
+    def write_read_i2c(self, address, wbuf, rcount):
+        if self._smbus and len(wbuf) == 1: # Register address goes out as the command byte
+            return self._smbus_read(address, wbuf[0], rcount)
+        if not self._rdwr:
+            return super().write_read_i2c(address, wbuf, rcount)
+        return self.transfer_i2c([(address, wbuf, rcount)])[0]
+
+    def read_block(self, address, reg, count, sticky=False):
+        if self._smbus: # The command byte is part of every block read anyway, bare reads would go byte by byte
+            return super().read_block(address, self._smbus_reg if reg is None else reg, count)
+        if not self._rdwr:
+            return super().read_block(address, reg, count, sticky)
+        bytes_per_trans = self.MAXIMUM_READ_AMOUNT if self.MAXIMUM_READ_AMOUNT else max(count, 1)
+        return b"".join(self.transfer_i2c([(address, b"" if reg is None or (sticky and byte_n) else bytes((reg,)),
+                                            min(count - byte_n, bytes_per_trans))
+                                           for byte_n in range(0, count, bytes_per_trans)]))
+
+    def write_block(self, address, reg, data):
+        if not self._rdwr:
+            return super().write_block(address, reg, data)
+        bytes_per_trans = self.MAXIMUM_WRITE_AMOUNT - 1 if self.MAXIMUM_WRITE_AMOUNT else max(len(data), 1)
+        self.transfer_i2c([(address, bytes((reg,)) + data[byte_n:byte_n+bytes_per_trans], 0)
+                           for byte_n in range(0, max(len(data), 1), bytes_per_trans)])
+
+    def transfer_i2c(self, messages):
+        if not self._rdwr:
+            return super().transfer_i2c(messages)
+        self._reserve(sum(len(wbuf) + rcount for _, wbuf, rcount in messages))
+        results = []
+        msgs    = []
+        reads   = []
+        offset  = 0
+        for address, wbuf, rcount in messages:
+            parts = (1 if wbuf or not rcount else 0) + (1 if rcount else 0)
+            if len(msgs) + parts > self._I2C_RDWR_MAX_MSGS: # Flush full call
+                self._rdwr_call(msgs)
+                results += [string_at(addressof(self._pool) + o, n) for o, n in reads]
+                msgs, reads = [], []
+            if wbuf or not rcount:
+                memmove(addressof(self._pool) + offset, bytes(wbuf), len(wbuf))
+                msgs.append((address, False, offset, len(wbuf)))
+                offset += len(wbuf)
+            if rcount: # Repeated start read, with the write above
+                msgs.append((address, True, offset, rcount))
+                reads.append((offset, rcount))
+                offset += rcount
+        if msgs:
+            self._rdwr_call(msgs)
+            results += [string_at(addressof(self._pool) + o, n) for o, n in reads]
+        return results
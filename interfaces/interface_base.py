@@ -1,3 +1,5 @@
+from misc.funcs import div_to_chunks
+
 class InterfaceBase:
     AVAILABLE_SYSTEMS = [ "" ]       # Values: [ "Windows", "Darwin", "Linux", ... ] # If [ "" ] then all systems
     AVAILABLE_ARCHITECTURES = [ "" ] # Values: [ "AMD64", "i386", ... ]              # If [ "" ] then all architectures
@@ -5,6 +7,8 @@ class InterfaceBase:
 
     MAXIMUM_READ_AMOUNT  = 0 # Maximum amount of bytes that can be read from the I2C bus in one transaction (Minimum is 2).  # If 0 then Unlimited
     MAXIMUM_WRITE_AMOUNT = 0 # Maximum amount of bytes that can be written to the I2C bus in one transaction (Minimum is 2). # If 0 then Unlimited
+    MAXIMUM_BATCH_AMOUNT = 1 # Maximum amount of transactions that can be queued in one transfer_i2c call.                    # If 1 then no batching, if 0 then Unlimited
+    BUFFER_API = False       # If True, data is passed in as bytes-like objects and returned as bytes, if False as lists of ints
 
     def list_i2c(self):
         """
@@ -48,6 +52,16 @@ class InterfaceBase:
         except Exception:
             return False
 
+    def tune_i2c(self, address):
+        """
+        Adapt the interface to the controller, called once it was found and put into ISP mode
+        Backends probing their transaction limits against the device should do it here, not in init_i2c
+
+        Arguments: address
+            address - 7-bit address of the controller on the I2C bus;
+        """
+        pass
+
     def write_i2c(self, address, data):
         """
         Write buffer to the I2C interface
@@ -69,4 +83,93 @@ class InterfaceBase:
         Returns: [data]
             data - data read from the device;
         """
-        return [0] * count
\ No newline at end of file
+        return bytes(count) if self.BUFFER_API else [0] * count
+
+    def write_read_i2c(self, address, wbuf, rcount):
+        """
+        Write buffer to, then read buffer from the I2C interface
+        Backends able to do it as one transaction with a repeated start should override this
+
+        Arguments: address, [wbuf], rcount
+            address - 7-bit address on the I2C bus;
+            wbuf - data to be written to the device (usually register address);
+            rcount - number of bytes to read;
+
+        Returns: [data]
+            data - data read from the device;
+        """
+        self.write_i2c(address, wbuf)
+        return self.read_i2c(address, rcount)
+
+    def _with_reg(self, reg, data):
+        """ Prepend register address 'reg' to 'data' in the form of the data API """
+        return bytes((reg,)) + data if self.BUFFER_API else [reg] + list(data)
+
+    def _join(self, chunks):
+        """ Concatenate read chunks in the form of the data API """
+        return b"".join(chunks) if self.BUFFER_API else sum(chunks, [])
+
+    def read_block(self, address, reg, count, sticky=False):
+        """
+        Read a block of data from a register of the device
+        By default it is split into MAXIMUM_READ_AMOUNT sized write-read transactions,
+        backends able to move the whole block in one native call should override this
+
+        Arguments: address, reg, count, sticky
+            address - 7-bit address on the I2C bus;
+            reg - register address to read from, None to read from where the register pointer of the device already is;
+            count - number of bytes to read;
+            sticky - reads don't move the register pointer of the device, so it is only sent before the first chunk;
+
+        Returns: [data]
+            data - data read from the device;
+        """
+        bytes_per_trans = self.MAXIMUM_READ_AMOUNT if self.MAXIMUM_READ_AMOUNT else max(count, 1)
+        chunks = []
+        for byte_n in range(0, count, bytes_per_trans):
+            if reg is None or (sticky and byte_n):
+                chunks.append(self.read_i2c(address, min(count - byte_n, bytes_per_trans)))
+            else:
+                chunks.append(self.write_read_i2c(address, self._with_reg(reg, b""), min(count - byte_n, bytes_per_trans)))
+        return self._join(chunks)
+
+    def write_block(self, address, reg, data):
+        """
+        Write a block of data into a register of the device
+        By default it is split into MAXIMUM_WRITE_AMOUNT sized transactions each starting with the register address,
+        backends able to move the whole block in one native call should override this
+
+        Arguments: address, reg, [data]
+            address - 7-bit address on the I2C bus;
+            reg - register address to write to;
+            data - data to be written to the register;
+        """
+        if self.MAXIMUM_WRITE_AMOUNT == 0:
+            self.write_i2c(address, self._with_reg(reg, data))
+        else:
+            for chunk in div_to_chunks(data, self.MAXIMUM_WRITE_AMOUNT-1):
+                self.write_i2c(address, self._with_reg(reg, chunk))
+
+    def transfer_i2c(self, messages):
+        """
+        Execute a batch of I2C transactions
+        By default they are executed one by one, backends able to queue several
+        transactions in one call should override this and set MAXIMUM_BATCH_AMOUNT
+
+        Arguments: [(address, [wbuf], rcount), ...]
+            address - 7-bit address on the I2C bus;
+            wbuf - data to be written to the device, if empty the transaction is a plain read;
+            rcount - number of bytes to read after writing, if 0 the transaction is a plain write;
+
+        Returns: [[data], ...]
+            data - data read by each transaction with non-zero rcount, in order;
+        """
+        results = []
+        for address, wbuf, rcount in messages:
+            if not rcount:
+                self.write_i2c(address, wbuf)
+            elif not wbuf:
+                results.append(self.read_i2c(address, rcount))
+            else:
+                results.append(self.write_read_i2c(address, wbuf, rcount))
+        return results
@@ -10,6 +10,7 @@ class I2C(InterfaceBase):
                  "and accesses device directly using libusb.")
     MAXIMUM_READ_AMOUNT  = 60
     MAXIMUM_WRITE_AMOUNT = 60
+    BUFFER_API = True
 
 
     _MCP2221_SPEED = 400000
@@ -132,12 +133,12 @@ class I2C(InterfaceBase):
             self._mcp2221 = None
 
     def write_i2c(self, address, data):
-        buffer = [
+        buffer = bytes([
             0x90,                    # I2C Write Data (command)
             len(data) & 0xFF,        # Requested I2C transfer length – 16-bit value – low byte
             (len(data) >> 8) & 0xFF, # Requested I2C transfer length – 16-bit value – high byte
             address << 1,            # 8-bit value representing the I2C slave address to communicate with (even – address to write, odd – address to read)
-        ]
+        ])
         buffer += data
         self._wait_till_ready()
         buffer = self._exch_hid(buffer)
@@ -146,8 +147,26 @@ class I2C(InterfaceBase):
 
     def read_i2c(self, address, count):
         self._wait_till_ready()
+        return self._read_data(0x91, address, count) # I2C Read Data (command)
+
+    def write_read_i2c(self, address, wbuf, rcount):
+        buffer = bytes([
+            0x94,                    # I2C Write Data No STOP (command)
+            len(wbuf) & 0xFF,        # Requested I2C transfer length – 16-bit value – low byte
+            (len(wbuf) >> 8) & 0xFF, # Requested I2C transfer length – 16-bit value – high byte
+            address << 1,            # 8-bit value representing the I2C slave address to communicate with (even – address to write, odd – address to read)
+        ])
+        buffer += wbuf
+        self._wait_till_ready()
+        buffer = self._exch_hid(buffer)
+        if buffer[1]:
+            raise ConnectionError("I2C Engine is busy (command not completed)")
+        # The engine now holds the bus without STOP, so don't wait for the idle state here
+        return self._read_data(0x93, address, rcount) # I2C Read Data Repeated START (command)
+
+    def _read_data(self, command, address, count):
         buffer = self._exch_hid([
-            0x91,                # I2C Read Data (command)
+            command,
             count & 0xFF,        # Requested I2C transfer length – 16-bit value – low byte
             (count >> 8) & 0xFF, # Requested I2C transfer length – 16-bit value – high byte
             (address << 1) | 1   # 8-bit value representing the I2C slave address to communicate with (even – address to write, odd – address to read)
@@ -161,7 +180,7 @@ class I2C(InterfaceBase):
         if buffer[1]:
             raise ConnectionError("Error reading the I2C slave data from the I2C engine")
         read_byte_count = buffer[3]
-        return list(buffer[4:4+read_byte_count])
+        return bytes(buffer[4:4+read_byte_count])
 
     def __del__(self):
         if self._mcp2221 is not None:
@@ -161,6 +161,44 @@ int read_i2c(libusb_device_handle *handle, uint8_t address, uint8_t *data, uint1
     return 0;
 }
 
+// Read a block from register `reg` (if negative, from where the device's register pointer is),
+// re-sending the register address before every chunk, or only before the first one if `sticky`
+int read_block(libusb_device_handle *handle, uint8_t address, int reg, uint8_t *data, uint32_t data_n, uint8_t sticky)
+{
+    int r;
+    uint8_t buf[64];
+    for (uint32_t i = 0; i < data_n; i += 60)
+    {
+        uint16_t n = (data_n - i) < 60 ? (data_n - i) : 60;
+        if (reg >= 0 && !(sticky && i))
+        {
+            buf[0] = reg;
+            r = write_i2c(handle, address, buf, 1);
+            if (r) return r;
+        }
+        r = read_i2c(handle, address, buf, n);
+        if (r) return r;
+        memcpy(&data[i], buf, n);
+    }
+    return 0;
+}
+
+// Write a block into register `reg`, every chunk starts with the register address
+int write_block(libusb_device_handle *handle, uint8_t address, uint8_t reg, uint8_t *data, uint32_t data_n)
+{
+    int r;
+    uint8_t buf[64];
+    for (uint32_t i = 0; i < data_n; i += 59)
+    {
+        uint16_t n = (data_n - i) < 59 ? (data_n - i) : 59;
+        buf[0] = reg;
+        memcpy(&buf[1], &data[i], n);
+        r = write_i2c(handle, address, buf, n + 1);
+        if (r) return r;
+    }
+    return 0;
+}
+
 
 // Test function
 void main()
@@ -11,6 +11,7 @@ class I2C(InterfaceBase):
                  "and accesses device directly using libusb,")
     MAXIMUM_READ_AMOUNT  = 60
     MAXIMUM_WRITE_AMOUNT = 60
+    BUFFER_API = True
 
 
     _lib = None
@@ -64,14 +65,33 @@ class I2C(InterfaceBase):
         self._lib.deinit_i2c(self._handle)
 
     def write_i2c(self, address, data):
-        dat = (c_uint8 * len(data))(*data)
+        dat = (c_uint8 * len(data)).from_buffer_copy(data)
         r = self._lib.write_i2c(self._handle, c_uint8(address), dat, c_uint16(len(data)))
         if r:
             raise ConnectionError(f"Runtime library error: {r}")
 
     def read_i2c(self, address, count):
-        dat = (c_ubyte * count)(*([0] * count))
+        dat = (c_ubyte * count)()
         r = self._lib.read_i2c(self._handle, c_uint8(address), dat, c_uint16(count))
         if r:
             raise ConnectionError(f"Runtime library error: {r}")
-        return list(dat)
\ No newline at end of file
+        return bytes(dat)
+
+    def read_block(self, address, reg, count, sticky=False):
+        # Libraries built before block transfers were added lack the function
+        if not hasattr(self._lib, "read_block"):
+            return super().read_block(address, reg, count, sticky)
+        dat = (c_ubyte * count)()
+        r = self._lib.read_block(self._handle, c_uint8(address), c_int(-1 if reg is None else reg), dat, c_uint32(count),
+                                 c_uint8(sticky))
+        if r:
+            raise ConnectionError(f"Runtime library error: {r}")
+        return bytes(dat)
+
+    def write_block(self, address, reg, data):
+        if not hasattr(self._lib, "write_block"):
+            return super().write_block(address, reg, data)
+        dat = (c_uint8 * len(data)).from_buffer_copy(data)
+        r = self._lib.write_block(self._handle, c_uint8(address), c_uint8(reg), dat, c_uint32(len(data)))
+        if r:
+            raise ConnectionError(f"Runtime library error: {r}")
\ No newline at end of file
@@ -11,6 +11,7 @@ class I2C(InterfaceBase):
                  "WARNING: Communication is available ONLY "
                  "if the display is detected (EDID is programmed and hot plug detect is active), "
                  "meaning that only preprogrammed controllers can be accessed.")
+    BUFFER_API = True
 
     nvapi = None
 
@@ -126,7 +127,7 @@ class I2C(InterfaceBase):
 
     def write_i2c(self, address, data):
         self.i2cInfo.i2cDevAddress = address << 1
-        dat = (c_uint8 * len(data))(*data)
+        dat = (c_uint8 * len(data)).from_buffer_copy(data)
         self.i2cInfo.pbData = dat
         self.i2cInfo.cbSize = len(data)
 
@@ -135,7 +136,7 @@ class I2C(InterfaceBase):
             raise ConnectionError("NvAPI_I2CWrite error. Return code: {0}".format(retCode))
 
     def read_i2c(self, address, count):
-        dat  = (c_ubyte * count)(*([0] * count))
+        dat  = (c_ubyte * count)()
         self.i2cInfo.pbData = dat
         self.i2cInfo.cbSize = count
 
@@ -143,4 +144,21 @@ class I2C(InterfaceBase):
         if retCode != 0:
             raise ConnectionError("NvAPI_I2CRead error. Return code: {0}".format(retCode))
 
-        return self.i2cInfo.pbData
\ No newline at end of file
+        return bytes(dat)
+
+    def write_read_i2c(self, address, wbuf, rcount):
+        # NVAPI sends the "register address" and reads back after a repeated start
+        self.i2cInfo.i2cDevAddress = address << 1
+        reg  = (c_uint8 * len(wbuf)).from_buffer_copy(wbuf)
+        self.i2cInfo.pbI2cRegAddress = reg
+        self.i2cInfo.regAddrSize = len(wbuf)
+        dat  = (c_ubyte * rcount)()
+        self.i2cInfo.pbData = dat
+        self.i2cInfo.cbSize = rcount
+
+        retCode = self.nvapiFunc["NvAPI_I2CRead"](self.hGpu, byref(self.i2cInfo))
+        self.i2cInfo.regAddrSize = 0
+        if retCode != 0:
+            raise ConnectionError("NvAPI_I2CRead error. Return code: {0}".format(retCode))
+
+        return bytes(dat)
@@ -0,0 +1,72 @@
+from misc.flashparams import *
+
+KiB = 2**10
+MiB = 2**20
+
+# Parameters of unknown flash chips
+#   size, page_size, sector_size, block_size: in bytes, sector_size is None if 4 KiB sectors can't be erased
+#   t_*: typical durations of page program (word program for AAI), sector, block and chip erase in seconds
+#   read_opcodes: supported read opcodes, in the order of preference
+#   program: "page" for page program, "aai_word" and "aai_byte" for SST Auto Address Increment programming
+#   ewsr: status register is made writable with EWSR instead of WREN
+DEFAULT_FLASH_CHIP = {
+    "name":           "Unknown",
+    "size":           READ_SIZE,
+    "page_size":      PAGE_SIZE,
+    "sector_size":    4 * KiB,
+    "block_size":     64 * KiB,
+    "t_page_program": T_PAGE_PROGRAM,
+    "t_sector_erase": 0.1,
+    "t_block_erase":  1,
+    "t_chip_erase":   T_CHIP_ERASE,
+    "read_opcodes":   ( READ, ),
+    "program":        "page",
+    "ewsr":           False,
+}
+
+def _chip(name, size, t_page_program, t_sector_erase, t_block_erase, t_chip_erase, read_opcodes=( FAST_READ, READ ),
+          **params):
+    chip = dict(DEFAULT_FLASH_CHIP, name=name, size=size, page_size=256, t_page_program=t_page_program,
+                t_sector_erase=t_sector_erase, t_block_erase=t_block_erase, t_chip_erase=t_chip_erase,
+                read_opcodes=read_opcodes)
+    chip.update(params)
+    return chip
+
+_DUAL = ( DUAL_READ, FAST_READ, READ )
+
+# Flash chips by JEDEC ID (manufacturer, memory type, capacity) as returned by RDID
+FLASH_CHIPS = {
+    # Macronix
+    0xC22012: _chip("MX25L2005",   256*KiB, 1.4e-3, 0.06, 0.7,  1.8),
+    0xC22013: _chip("MX25L4005",   512*KiB, 1.4e-3, 0.06, 0.7,  3.5),
+    0xC22014: _chip("MX25L8005",     1*MiB, 1.4e-3, 0.06, 0.7,  7),
+    0xC22015: _chip("MX25L1605",     2*MiB, 1.4e-3, 0.06, 0.7,  14),
+    # Winbond
+    0xEF3012: _chip("W25X20",      256*KiB, 1.5e-3, 0.15, 1,    2,   _DUAL),
+    0xEF3013: _chip("W25X40",      512*KiB, 1.5e-3, 0.15, 1,    4,   _DUAL),
+    0xEF3014: _chip("W25X80",        1*MiB, 1.5e-3, 0.15, 1,    8,   _DUAL),
+    0xEF4013: _chip("W25Q40",      512*KiB, 0.7e-3, 0.045, 0.15, 1.5, _DUAL),
+    0xEF4014: _chip("W25Q80",        1*MiB, 0.7e-3, 0.045, 0.15, 3,   _DUAL),
+    0xEF4015: _chip("W25Q16",        2*MiB, 0.7e-3, 0.045, 0.15, 5,   _DUAL),
+    # GigaDevice
+    0xC84013: _chip("GD25Q40",     512*KiB, 0.6e-3, 0.05, 0.3,  3,   _DUAL),
+    0xC84014: _chip("GD25Q80",       1*MiB, 0.6e-3, 0.05, 0.3,  6,   _DUAL),
+    0xC84015: _chip("GD25Q16",       2*MiB, 0.6e-3, 0.05, 0.3,  12,  _DUAL),
+    # Eon
+    0x1C3113: _chip("EN25F40",     512*KiB, 1.5e-3, 0.09, 0.5,  5),
+    0x1C3114: _chip("EN25F80",       1*MiB, 1.5e-3, 0.09, 0.5,  10),
+    # AMIC
+    0x373013: _chip("A25L040",     512*KiB, 1.5e-3, 0.06, 0.6,  4,   _DUAL),
+    # Micron / Numonyx / ST, only 64 KiB sectors
+    0x202013: _chip("M25P40",      512*KiB, 0.8e-3, None, 0.6,  4.5, sector_size=None),
+    0x202014: _chip("M25P80",        1*MiB, 0.8e-3, None, 0.6,  8,   sector_size=None),
+    # SST, no page program, programmed with Auto Address Increment word program
+    0xBF258C: _chip("SST25VF020B", 256*KiB, 10e-6, 0.018, 0.018, 0.035, program="aai_word", ewsr=True),
+    0xBF258D: _chip("SST25VF040B", 512*KiB, 10e-6, 0.018, 0.018, 0.035, program="aai_word", ewsr=True),
+    0xBF258E: _chip("SST25VF080B",   1*MiB, 10e-6, 0.018, 0.018, 0.035, program="aai_word", ewsr=True),
+    0xBF2541: _chip("SST25VF016B",   2*MiB, 10e-6, 0.018, 0.018, 0.035, program="aai_word", ewsr=True),
+}
+
+def get_flash_chip(jedec_id):
+    """ Return parameters of the flash chip with given JEDEC ID, defaults if it is unknown """
+    return FLASH_CHIPS.get(jedec_id, DEFAULT_FLASH_CHIP)
@@ -5,11 +5,48 @@ RDSR = 0x05
 EWSR = 0x50
 WRSR = 0x01
 READ = 0x03
+FAST_READ = 0x0B
+DUAL_READ = 0x3B
 PRGM = 0x02
+AAI_WORD = 0xAD # SST Auto Address Increment word program
+AAI_BYTE = 0xAF # SST Auto Address Increment byte program
 ERAS = 0x60
+ERAS_SECTOR = 0x20 # 4 KiB sector erase
+ERAS_BLOCK  = 0xD8 # 64 KiB block erase
 RDID = 0x9F
 
+# Dummy bytes the read opcodes shift out before the data
+READ_DUMMY_BYTES = { READ: 0, FAST_READ: 1, DUAL_READ: 1 }
+# Read opcodes the controller may stream through 0x70, it samples a single data line
+# Only READ is known to work, the others are opt-in until checked on the hardware (rtdmultiprog_bench.py -r)
+CONTROLLER_READ_OPCODES = ( READ, FAST_READ )
+
+# Program opcodes by programming method of the flash chip
+PROGRAM_OPCODES = { "page": PRGM, "aai_word": AAI_WORD, "aai_byte": AAI_BYTE }
+
+# Programming size used for unknown flash chips
 PAGE_SIZE = 128
+# Size of the controller's programming buffer behind register 0x70, 0x71 holds size - 1
+ISP_BUFFER_SIZE = 256
+
+# Typical durations of flash operations, used as polling hints for unknown flash chips (seconds)
+T_PAGE_PROGRAM = 1.5e-3 # Page program
+T_CHIP_ERASE   = 2      # Chip erase
+T_CRC_PER_BYTE = 0.1e-6 # On-chip CRC calculation, per byte
+
+# Retries of failed transactions and operations, and the wait before the first retry, doubled for every further one
+RETRY_BUDGET  = 3
+RETRY_BACKOFF = 0.01
+
+# Words of an AAI sequence sent in one plan, a failed plan is repeated in halves from new sequences
+AAI_RETRY_WORDS = 16
+
+# Attempts to rewrite a sector which fails verification while writing
+WRITE_RETRIES = 3
+
+# Timed page programming: pages polled to calibrate the page program time and the margin added to it
+PRGM_CALIBRATION_PAGES = 8
+PRGM_TIME_MARGIN       = 1.25
 
 # Default read size 512 KiB
 READ_SIZE = 512 * 2**10
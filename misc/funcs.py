@@ -1,12 +1,45 @@
 import time
 
-def poll(func, exception_message=None, timeout=2, step=0.1):
-    """ Execute function until it returns True or times out """
-    t_start = time.time()
+POLL_MIN_STEP = 50e-6 # First backoff step of poll()
+POLL_MAX_STEP = 0.1   # Longest sleep between two checks of poll()
+
+# Polling statistics by operation name: { name: { "polls", "checks", "total", "max" } }
+poll_stats = {}
+
+def poll(func, exception_message=None, timeout=2, step=None, expected=0, name=None):
+    """ Execute function until it returns True or times out
+        With a fixed 'step' sleep that long between checks. Otherwise the first sleep lasts the 'expected'
+        duration of the operation, then it backs off exponentially from POLL_MIN_STEP up to POLL_MAX_STEP.
+        If 'name' is given, latency statistics are collected in poll_stats """
+    t_start = time.perf_counter()
+    checks  = 1
+    delay   = expected if expected else POLL_MIN_STEP
+    backoff = POLL_MIN_STEP
     while not func():
-        time.sleep(step)
-        if time.time() - t_start >= timeout:
+        if step is not None:
+            time.sleep(step)
+        else:
+            time.sleep(min(delay, POLL_MAX_STEP))
+            delay    = backoff
+            backoff *= 2
+        checks += 1
+        if time.perf_counter() - t_start >= timeout:
             raise TimeoutError(exception_message)
+    if name is not None:
+        elapsed = time.perf_counter() - t_start
+        stats   = poll_stats.setdefault(name, { "polls": 0, "checks": 0, "total": 0.0, "max": 0.0 })
+        stats["polls"]  += 1
+        stats["checks"] += checks
+        stats["total"]  += elapsed
+        stats["max"]     = max(stats["max"], elapsed)
+
+def to_bytes(data):
+    """ Convert an int, a list of ints or a bytes-like object into bytes, ints are capped to the byte range """
+    if isinstance(data, int):
+        return bytes((data & 0xFF,))
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return bytes(data)
+    return bytes(i & 0xFF for i in data)
 
 def div_to_chunks(L, n):
     """ Yield successive n-sized chunks from L """
@@ -0,0 +1,74 @@
+import os
+
+JOURNAL_SUFFIX = ".journal"
+
+class Journal:
+    """ Record of the confirmed parts of a read or write session, kept next to its file as '<file>.journal'
+        The first line identifies the session, every further line is one confirmed area "start end crc".
+        Lines are flushed as soon as they are written, so the journal survives a crash or Ctrl-C """
+
+    def __init__(self, filename, header):
+        self.path    = filename + JOURNAL_SUFFIX
+        self.header  = header
+        self.entries = self._load() # [(start, end, crc), ...] of the previous session, if it was the same
+        self.file    = None
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, "r") as fj:
+            lines = fj.read().split("\n")
+        if lines[0] != self.header:
+            return []
+        entries = []
+        for line in lines[1:]:
+            try:
+                start, end, crc = (int(field, 0) for field in line.split())
+            except ValueError: # Last line may be cut off
+                break
+            entries.append((start, end, crc))
+        return entries
+
+    def resume_point(self, check):
+        """ End of the confirmed areas of the previous session, up to the first one failing check(start, end, crc)
+            Areas are in ascending order, gaps between them are areas the session had nothing to do in """
+        done = 0
+        for start, end, crc in self.entries:
+            if start < done or not check(start, end, crc):
+                break
+            done = end
+        return done
+
+    def start(self, done=0):
+        """ Start journaling a session resuming at 'done'. Used as context manager, the journal is removed
+            when the session ends without an exception and kept for resuming otherwise.
+            If the journal can't be created the session runs without it """
+        try:
+            self.file = open(self.path, "w")
+        except OSError as e:
+            print(f"WARNING: Can't create journal {self.path} ({e.strerror}), an interruption can't be resumed")
+            return self
+        self.file.write(self.header + "\n")
+        for start, end, crc in self.entries:
+            if end <= done:
+                self.record(start, end, crc)
+        self.file.flush()
+        return self
+
+    def record(self, start, end, crc):
+        """ Confirm area [start, end) with 'crc' of its content """
+        if self.file is None:
+            return
+        self.file.write(f"{start:#x} {end:#x} {crc:#04x}\n")
+        self.file.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        if exc_type is None:
+            os.remove(self.path)
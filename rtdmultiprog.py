@@ -1,8 +1,11 @@
 #!/usr/bin/env python3
 
-import os, platform, sys
+import mmap, os, platform, sys, time
+from functools        import lru_cache
 from misc.flashparams import *
+from misc.flashchips  import *
 from misc.funcs       import *
+from misc.journal     import Journal
 from importlib        import import_module
 from genericpath      import exists
 from argparse         import ArgumentParser
@@ -16,6 +19,31 @@ parameters = None
 # Global definition of the current interface
 iface = None
 
+# Last values written to the controller registers in this ISP session
+reg_shadow   = {}
+shadow_stats = { "written": 0, "skipped": 0 } # Register writes done and saved by the shadow
+# Last value written to the status register of the flash, None if unknown
+flash_status = None
+# JEDEC ID and parameters of the connected flash chip, looked up by setup_flash()
+flash_id     = None
+flash_chip   = DEFAULT_FLASH_CHIP
+# Opcode read_flash() streams the flash with, chosen by setup_flash()
+read_opcode  = READ
+# Page program time calibrated by the timed programming mode, None if not calibrated for this chip
+calibrated_page_time = None
+# Pages and sectors rewritten by the verification while writing
+write_retries = { "pages": 0, "sectors": 0 }
+
+# Retries after failed transactions by operation name
+retry_stats   = {}
+retry_budget  = RETRY_BUDGET
+retry_backoff = RETRY_BACKOFF
+
+# Register the I2C register pointer of the controller is known to be at, None if unknown
+reg_pointer    = None
+# Reads don't move the register pointer, so it needn't be resent (verified by check_sticky_pointer)
+sticky_pointer = False
+
 # Alias for os.sep
 SEP = os.sep
 
@@ -31,14 +59,40 @@ CI_WRITE_AFTER_WREN = 3
 CI_WRITE_AFTER_EWSR = 4
 CI_ERASE = 5
 
+# Registers which can be written as a contiguous run in one auto-incrementing transaction,
+# writing them only stores the value. Triggers (0x60, 0x6F), the data port (0x70),
+# results (0x67-0x69, 0x75) and undocumented registers are excluded.
+AUTOINC_SAFE_REGS = {
+    0x61,             # Custom instruction opcode
+    0x62, 0x63,       # WREN and EWSR opcodes
+    0x64, 0x65, 0x66, # Flash address / custom instruction operands
+    0x6A,             # Read opcode
+    0x6D, 0x6E,       # Program and RDSR opcodes
+    0x71,             # Program size
+    0x72, 0x73, 0x74, # CRC end address
+}
 
-def calculate_crc(data):
-    """ Calculate CRC-8-CCITT (Poly: x^8 + x^2 + x + 1) """
-    crc = 0x00
-    for byte in data:
-        crc ^= byte
+# Registers which are never shadowed, writing them has side effects or they change on their own
+VOLATILE_REGS = { 0x60, 0x67, 0x68, 0x69, 0x6F, 0x70, 0x75, 0xEE }
+# Registers the controller may change while running an operation (custom instruction, program, CRC)
+ENGINE_CLOBBERED_REGS = { 0x64, 0x65, 0x66 }
+
+
+def crc_table():
+    """ CRC-8-CCITT of every single byte value, processes a byte per lookup """
+    table = []
+    for crc in range(256):
         for _ in range(8):
             crc = ((crc << 1) ^ 0x07 if crc & 0x80 else crc << 1) & 0xFF
+        table.append(crc)
+    return table
+
+CRC_TABLE = crc_table()
+
+def calculate_crc(data, crc=0x00):
+    """ Calculate CRC-8-CCITT (Poly: x^8 + x^2 + x + 1), continuing the 'crc' of preceding data """
+    for byte in data:
+        crc = CRC_TABLE[crc ^ byte]
     return crc
 
 def is_empty_page(data):
@@ -48,36 +102,204 @@ def is_empty_page(data):
             return False
     return True
 
+def in_ranges(address, ranges):
+    """ Test if 'address' lies inside of any of 'ranges' [(start, end), ...], None covers everything """
+    return ranges is None or any(start <= address < end for start, end in ranges)
 
-def write_reg(address, data, is_autoinc=False):
-    # Single int to list of one element
-    if isinstance(data, int):
-        data = [data]
-    # Cap integers to byte range
-    data = [(i & 0xFF) for i in data]
-    # Divide list into chunks with address appended
-    if iface.MAXIMUM_WRITE_AMOUNT == 0:
-        data = [[address] + data]
+def region_crcs(data):
+    """ CRCs of a region and of its first half, two CRC-8s make missing a changed region unlikely """
+    return calculate_crc(data), calculate_crc(data[:max(len(data) // 2, 1)])
+
+@lru_cache()
+def blank_region_crcs(size):
+    """ region_crcs() of 'size' bytes of erased flash """
+    return region_crcs([0xFF] * size)
+
+
+def invalidate_shadow(regs=None):
+    """ Forget shadowed values of 'regs', or of all registers if None """
+    global flash_status
+    if regs is None:
+        reg_shadow.clear()
+        flash_status = None
     else:
-        data = [[address] + i for i in div_to_chunks(data, iface.MAXIMUM_WRITE_AMOUNT-1)]
-    for chunk in data:
-        iface.write_i2c(RTD_ISP_AUTOINC_ADR if is_autoinc else RTD_ISP_ADR, chunk)
+        for reg in regs:
+            reg_shadow.pop(reg, None)
+
+def shadow_filter(address, data, is_autoinc=False):
+    """ Drop registers already holding the written value from both ends of a write and update the shadow
+        Returns: (address, [data]) left to be written, or None if nothing is """
+    regs   = [address + i for i in range(len(data))] if is_autoinc else [address]
+    values = data if is_autoinc else data[-1:]
+    if any(reg in VOLATILE_REGS for reg in regs) or (not is_autoinc and len(data) != 1):
+        shadow_stats["written"] += len(regs)
+        if address == 0xEE:
+            invalidate_shadow()
+        else:
+            invalidate_shadow(regs) # Volatile registers aren't shadowed, keep the others honest too
+            if address in (0x60, 0x6F):
+                invalidate_shadow(ENGINE_CLOBBERED_REGS)
+        return address, data
+
+    start, end = 0, len(regs)
+    while start < end and reg_shadow.get(regs[start]) == values[start]:
+        start += 1
+    while end > start and reg_shadow.get(regs[end-1]) == values[end-1]:
+        end -= 1
+    shadow_stats["skipped"] += len(regs) - (end - start)
+    shadow_stats["written"] += end - start
+    if start == end:
+        return None
+    reg_shadow.update(zip(regs[start:end], values[start:end]))
+    return address + start, data[start:end]
+
+def iface_data(data):
+    """ Bytes 'data' in the form the interface takes, lists of ints for plugins without BUFFER_API """
+    return data if iface.BUFFER_API else list(data)
+
+def iface_message(reg, data):
+    """ Write buffer of register address 'reg' followed by bytes 'data' in the form the interface takes """
+    return bytes((reg,)) + data if iface.BUFFER_API else [reg] + list(data)
+
+def write_reg(address, data, is_autoinc=False):
+    # Single int, list of ints or bytes-like object to bytes capped to byte range
+    data = to_bytes(data)
+    # Skip registers known to hold the value already
+    write = shadow_filter(address, data, is_autoinc)
+    if write is None:
+        return
+    address, data = write
+    # Interface divides the data into transactions it can handle
+    global reg_pointer
+    reg_pointer = None
+    regs = range(address, address + len(data)) if is_autoinc else [address]
+    write_block = lambda: iface.write_block(RTD_ISP_AUTOINC_ADR if is_autoinc else RTD_ISP_ADR, address,
+                                            iface_data(data))
+    try:
+        if any(reg in VOLATILE_REGS for reg in regs):
+            write_block() # Not repeatable, the operation is retried as a whole
+        else:
+            retry("register", write_block, recover=False)
+    except Exception:
+        invalidate_shadow(regs) # Unknown how much of the write got through
+        raise
+    reg_pointer = None if is_autoinc else address
 
 def read_reg(address, count=1, is_autoinc=False):
-    if iface.MAXIMUM_READ_AMOUNT == 0:
-        bytes_per_trans = count
+    if address == 0x70 or (is_autoinc and address < 0x70 < address + count):
+        return read_reg_once(address, count, is_autoinc) # Stream reads are retried by their operation
+    return retry("register", lambda: read_reg_once(address, count, is_autoinc), recover=False)
+
+def read_reg_once(address, count=1, is_autoinc=False):
+    global reg_pointer
+    if is_autoinc or not sticky_pointer:
+        reg_pointer = None
+        data = iface.read_block(RTD_ISP_AUTOINC_ADR if is_autoinc else RTD_ISP_ADR, address, count)
     else:
-        bytes_per_trans = iface.MAXIMUM_READ_AMOUNT
-    data = []
-    for byte_n in range(0, count, bytes_per_trans):
-        iface.write_i2c(RTD_ISP_ADR, [address])
-        data += iface.read_i2c(RTD_ISP_AUTOINC_ADR if is_autoinc else RTD_ISP_ADR,
-                               min(count - byte_n, bytes_per_trans))
-    return data
+        # Register address is only sent if the pointer is somewhere else
+        reg = None if reg_pointer == address else address
+        reg_pointer = None
+        data = iface.read_block(RTD_ISP_ADR, reg, count, sticky=True)
+    reg_pointer = None if is_autoinc else address
+    return bytes(data) # No copy if the interface returned bytes already
+
+def check_sticky_pointer():
+    """ Test whether the controller keeps its register pointer on a register after reading and writing it,
+        enable reads without resending the register address if it does """
+    global sticky_pointer
+    sticky_pointer = False
+    sticky_pointer = retry("register", probe_sticky_pointer, recover=False) # The probe is repeatable as a whole
+    return sticky_pointer
+
+def probe_sticky_pointer():
+    invalidate_shadow((0x72, 0x73, 0x74)) # Rewritten on every attempt, the pointer has to end up on them
+    write_regs(0x72, [0xA5, 0x5A]) # CRC end address, harmless until a CRC is started
+    for reg, value in ((0x72, 0xA5), (0x73, 0x5A)):
+        if iface.write_read_i2c(RTD_ISP_ADR, iface_message(reg, b""), 1)[0] != value or \
+           iface.read_i2c(RTD_ISP_ADR, 1)[0] != value:
+            return False
+    write_reg(0x74, 0xC3)
+    return bytes(iface.read_i2c(RTD_ISP_ADR, 2)) == b"\xC3\xC3"
+
+def reg_group_chunks(address, data):
+    """ Split write of consecutive registers starting at 'address' into (register, [data], is_autoinc) writes """
+    if isinstance(data, int):
+        data = [data]
+    if len(data) == 1 or not all(address + i in AUTOINC_SAFE_REGS for i in range(len(data))):
+        return [(address + i, [value], False) for i, value in enumerate(data)]
+    # Every transaction restarts at its own register, so the run is split by hand
+    regs_per_trans = iface.MAXIMUM_WRITE_AMOUNT - 1 if iface.MAXIMUM_WRITE_AMOUNT else len(data)
+    return [(address + i, data[i:i+regs_per_trans], True) for i in range(0, len(data), regs_per_trans)]
+
+def write_regs(address, data):
+    """ Write consecutive registers, with one auto-incrementing transaction where it is safe """
+    for reg, chunk, is_autoinc in reg_group_chunks(address, data):
+        write_reg(reg, chunk, is_autoinc)
+
+
+class TransactionPlan:
+    """ Sequence of register writes without dependencies between them,
+        executed as one batch on interfaces supporting it, step by step elsewhere """
+
+    def __init__(self):
+        self.steps = [] # [(i2c_address, register, b"data"), ...]
+
+    def write_reg(self, address, data, is_autoinc=False):
+        # Shadow is updated when the plan is built, execute() drops it if the plan fails
+        write = shadow_filter(address, to_bytes(data), is_autoinc)
+        if write is not None:
+            self.steps.append((RTD_ISP_AUTOINC_ADR if is_autoinc else RTD_ISP_ADR, write[0], write[1]))
+        return self
+
+    def write_regs(self, address, data):
+        for reg, chunk, is_autoinc in reg_group_chunks(address, data):
+            self.write_reg(reg, chunk, is_autoinc)
+        return self
+
+    def compile(self):
+        """ Flatten the steps into I2C write transactions fitting the interface limits
+            Returns: [(address, wbuf, 0), ...] """
+        messages = []
+        for i2c_address, reg, data in self.steps:
+            if iface.MAXIMUM_WRITE_AMOUNT == 0:
+                messages.append((i2c_address, iface_message(reg, data), 0))
+            else:
+                messages += [(i2c_address, iface_message(reg, chunk), 0)
+                             for chunk in div_to_chunks(data, iface.MAXIMUM_WRITE_AMOUNT-1)]
+        return messages
+
+    def execute(self):
+        """ Run the plan """
+        global reg_pointer
+        reg_pointer = None
+        try:
+            self._execute()
+        except Exception:
+            # Unknown how much of the plan got through
+            invalidate_shadow(written for i2c_address, reg, data in self.steps
+                              for written in (range(reg, reg + len(data)) if i2c_address == RTD_ISP_AUTOINC_ADR
+                                              else [reg]))
+            raise
+        if self.steps and self.steps[-1][0] == RTD_ISP_ADR:
+            reg_pointer = self.steps[-1][1]
+
+    def _execute(self):
+        if iface.MAXIMUM_BATCH_AMOUNT == 1:
+            for i2c_address, reg, data in self.steps:
+                iface.write_block(i2c_address, reg, iface_data(data))
+            return
+
+        messages   = self.compile()
+        batch_size = iface.MAXIMUM_BATCH_AMOUNT if iface.MAXIMUM_BATCH_AMOUNT else len(messages)
+        for batch in div_to_chunks(messages, max(batch_size, 1)):
+            iface.transfer_i2c(batch)
 
 
 def enter_isp():
     """ Enable In-System Programming mode, Disable internal MCU """
+    global reg_pointer
+    invalidate_shadow() # Nothing is known about a new session
+    reg_pointer = None
     write_reg(0x6F, 0x80)
     if not (read_reg(0x6F)[0] & 0x80):
         raise ConnectionError("Failed to enter into ISP mode")
@@ -89,23 +311,65 @@ def reboot_controller():
         #write_reg(0x6F, 0x00)
     except ConnectionError:
         pass
+    invalidate_shadow()
 
-def isp_custom_instruction(cmd_type, cmd_code, read_n, write_n, write_value):
+def retry(name, func, recover=True, on_retry=None):
+    """ Call 'func' until it succeeds, at most 'retry_budget' more times after failed transactions
+        The wait before a retry starts at 'retry_backoff' and doubles with every attempt. With 'recover' the
+        controller is brought back to the shadowed state by recover_isp() first, then 'on_retry' is called
+        to resume the operation """
+    for attempt in range(retry_budget + 1):
+        try:
+            if attempt:
+                if recover:
+                    recover_isp()
+                if on_retry is not None:
+                    on_retry()
+            return func()
+        except OSError: # ConnectionError, TimeoutError and errors of the interface libraries
+            if attempt == retry_budget:
+                raise
+            retry_stats[name] = retry_stats.get(name, 0) + 1
+            time.sleep(retry_backoff * 2**attempt)
+
+def recover_isp():
+    """ Re-enter ISP mode, which also restarts the programming buffer, and write the shadowed registers again,
+        in case the controller lost them """
+    global flash_status
+    registers, status = dict(reg_shadow), flash_status
+    enter_isp()
+    for reg, value in sorted(registers.items()):
+        if reg not in VOLATILE_REGS: # Writing these again would repeat their action
+            write_reg(reg, value)
+    flash_status = status # Held by the flash, not by the controller
+
+def isp_custom_instruction(cmd_type, cmd_code, read_n, write_n, write_value, expected=None):
+    """ Execute custom instruction, 'expected' is the typical duration of the instruction in seconds
+        The instruction is executed again after failed transactions """
+    return retry("erase" if cmd_type == CI_ERASE else "custom_instruction",
+                 lambda: run_custom_instruction(cmd_type, cmd_code, read_n, write_n, write_value, expected))
+
+def run_custom_instruction(cmd_type, cmd_code, read_n, write_n, write_value, expected=None):
+    plan = TransactionPlan()
     if   write_n == 1:
-        write_reg(0x64, write_value)
+        plan.write_reg(0x64, write_value)
     elif write_n == 2:
-        write_reg(0x64, write_value >> 8)
-        write_reg(0x65, write_value)
+        plan.write_regs(0x64, [write_value >> 8, write_value])
     elif write_n == 3:
-        write_reg(0x64, write_value >> 16)
-        write_reg(0x65, write_value >> 8)
-        write_reg(0x66, write_value)
+        plan.write_regs(0x64, [write_value >> 16, write_value >> 8, write_value])
 
     # Execute custom instruction and wait until done
-    write_reg(0x61, cmd_code)
-    write_reg(0x60, (cmd_type<<5) | (write_n<<3) | (read_n<<1) | 1)
-    timeout = 20 if cmd_type == CI_ERASE else 2
-    poll(lambda: not read_reg(0x60)[0] & 0x01, "Custom Instruction Timeout", timeout)
+    plan.write_reg(0x61, cmd_code)
+    plan.write_reg(0x60, (cmd_type<<5) | (write_n<<3) | (read_n<<1) | 1)
+    plan.execute()
+    if cmd_type == CI_ERASE:
+        if expected is None:
+            expected = flash_chip["t_chip_erase"]
+        timeout, name = max(20, expected * 10), "erase"
+    else:
+        timeout, name = 2, "custom_instruction"
+    poll(lambda: not read_reg(0x60)[0] & 0x01, "Custom Instruction Timeout", timeout,
+         expected=expected or 0, name=name)
 
     if   read_n == 1:
         return  read_reg(0x67)[0]
@@ -117,79 +381,469 @@ def isp_custom_instruction(cmd_type, cmd_code, read_n, write_n, write_value):
         return None
 
 def isp_get_crc(start_address, end_address):
-    write_reg(0x64, start_address >> 16)
-    write_reg(0x65, start_address >> 8)
-    write_reg(0x66, start_address)
+    return retry("crc", lambda: run_crc(start_address, end_address))
 
-    write_reg(0x72, end_address >> 16)
-    write_reg(0x73, end_address >> 8)
-    write_reg(0x74, end_address)
+def run_crc(start_address, end_address):
+    plan = TransactionPlan()
+    plan.write_regs(0x64, [start_address >> 16, start_address >> 8, start_address])
+    plan.write_regs(0x72, [end_address >> 16, end_address >> 8, end_address])
 
     # Start CRC calculation and wait until done
-    write_reg(0x6F, 0x84)
-    poll(lambda: read_reg(0x6F)[0] & 0x02, "CRC Read Timeout")
+    plan.write_reg(0x6F, 0x84)
+    plan.execute()
+    poll(lambda: read_reg(0x6F)[0] & 0x02, "CRC Read Timeout",
+         expected=(end_address - start_address + 1) * T_CRC_PER_BYTE, name="crc")
 
     return read_reg(0x75)[0]
 
 def get_flash_id():
-    return isp_custom_instruction(CI_READ, RDID, 2, 0, 0x00)
+    return isp_custom_instruction(CI_READ, RDID, 3, 0, 0x00)
+
+def program_page_size():
+    """ Number of bytes programmed at once, the flash page limited by the controller's buffer """
+    return min(flash_chip["page_size"], ISP_BUFFER_SIZE)
+
+def write_flash_status(value):
+    """ Write status register of the flash (block protection bits), unless it already holds the value """
+    global flash_status
+    if flash_status == value:
+        shadow_stats["skipped"] += 1
+        return
+    flash_status = None
+    isp_custom_instruction(CI_WRITE_AFTER_EWSR if flash_chip["ewsr"] else CI_WRITE_AFTER_WREN, WRSR, 0, 1, value)
+    flash_status = value
+
+def chip_region_crcs(start, end):
+    """ region_crcs() of the flash area [start, end), calculated by the controller """
+    return isp_get_crc(start, end - 1), isp_get_crc(start, start + max((end - start) // 2, 1) - 1)
+
+def is_blank(start, end):
+    """ Test if the flash area [start, end) only contains 0xFF """
+    return chip_region_crcs(start, end) == blank_region_crcs(end - start)
+
+def erase_sector_size():
+    """ Smallest erasable unit of the flash """
+    return flash_chip["sector_size"] or flash_chip["block_size"]
+
+def erase_sector(address):
+    isp_custom_instruction(CI_ERASE, ERAS_SECTOR, 0, 3, address, flash_chip["t_sector_erase"])
+
+def erase_block(address):
+    isp_custom_instruction(CI_ERASE, ERAS_BLOCK, 0, 3, address, flash_chip["t_block_erase"])
+
+def erase_range(start, end):
+    """ Erase the sectors covering the flash area [start, end), with block erase where a whole block is covered
+        The flash has to be unprotected """
+    sector = erase_sector_size()
+    block  = flash_chip["block_size"]
+    limit  = -(-end // sector) * sector # End of the last covered sector
+    address = start - start % sector
+    while address < limit:
+        if address % block == 0 and address + block <= limit:
+            erase_block(address)
+            address += block
+        else:
+            erase_sector(address)
+            address += sector
 
-def erase_flash():
+def diff_blocks(data, block_size=None, known=None, progress_callback=lambda s, e, c: None):
+    """ Compare 'data' with the flash block by block, with on-chip CRCs or with the 'known' flash content
+        Blocks are erase sectors if 'block_size' is None.
+        Returns: [(start, end), ...] merged areas of differing blocks """
+    block  = block_size or erase_sector_size()
+    ranges = []
+    for start in range(0, len(data), block):
+        progress_callback(0, len(data), start)
+        end = min(start + block, len(data))
+        if known is not None:
+            changed = list(known[start:end]) != list(data[start:end])
+        else:
+            changed = chip_region_crcs(start, end) != region_crcs(data[start:end])
+        if not changed:
+            continue
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+    progress_callback(0, len(data), len(data)) # Signal 100% to progress function
+    return ranges
+
+def verify_flash(data, block_size=None, progress_callback=lambda s, e, c: None):
+    """ Compare 'data' with the beginning of the flash using on-chip CRCs of its blocks
+        Returns: [(start, end), ...] merged areas of mismatching blocks """
+    print(f"Will verify {len(data) / 1024:.1f} KiB")
+    return diff_blocks(data, block_size, progress_callback=progress_callback)
+
+def blank_check(size=None, block_size=None, progress_callback=lambda s, e, c: None):
+    """ Find non-blank blocks in the first 'size' bytes of the flash, the whole chip if None, with on-chip CRCs
+        Returns: [(start, end), ...] merged areas of non-blank blocks """
+    size   = size or flash_chip["size"]
+    block  = block_size or flash_chip["block_size"]
+    ranges = []
+    for start in range(0, size, block):
+        progress_callback(0, size, start)
+        end = min(start + block, size)
+        if is_blank(start, end):
+            continue
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+    progress_callback(0, size, size) # Signal 100% to progress function
+    return ranges
+
+def erase_flash(protect=True, blank_size=None):
+    """ Erase the whole flash, unless its first 'blank_size' bytes are already blank if given """
+    if blank_size is not None and not blank_check(blank_size):
+        print("Flash is blank, erase skipped")
+        return
     print("Erasing... ", end='')
-    isp_custom_instruction(CI_WRITE_AFTER_WREN, WRSR, 0, 1, 0x00) # Unprotect the flash
-    isp_custom_instruction(CI_ERASE, ERAS, 0, 0, 0x00)            # Erase the flash
-    isp_custom_instruction(CI_WRITE_AFTER_WREN, WRSR, 0, 1, 0x1C) # Protect the flash
+    write_flash_status(0x00)                           # Unprotect the flash
+    isp_custom_instruction(CI_ERASE, ERAS, 0, 0, 0x00) # Erase the flash
+    if protect:
+        write_flash_status(0x1C)                       # Protect the flash
     print("done")
 
-def program_flash(data, progress_callback=lambda s, e, c: None):
+def plan_program_page(address, page, upload=True, start=True, plan=None):
+    """ Compile programming of one page into a transaction plan, appended to 'plan' if given
+        'upload' writes size and content of the page, 'start' the address and the start of programming """
+    if plan is None:
+        plan = TransactionPlan()
+    if upload:
+        # Set write size
+        plan.write_reg(0x71, len(page) - 1)
+        # Write the content to on chip buffer
+        plan.write_reg(0x70, page)
+    if start:
+        # Set the programming address, the engine may change it while busy
+        plan.write_regs(0x64, [address >> 16, address >> 8, address])
+        # Begin flash programming
+        plan.write_reg(0x6F, 0xA0)
+    return plan
+
+def program_flash(data, progress_callback=lambda s, e, c: None, pipelined=False, timed=False,
+                  differential=False, known=None, verify_writes=False, resume_at=0, page_callback=lambda s, e: None):
+    """ Program 'data' from the beginning of the flash
+        'pipelined' and 'timed' select the page programming mode, see program_pages().
+        'differential' erases and programs only the sectors which differ from the flash, compared with
+        on-chip CRCs or with the 'known' flash content if given. Without it the flash must be erased.
+        'verify_writes' checks every sector after programming it and rewrites it if it failed.
+        'resume_at' skips the part of 'data' an interrupted session already programmed.
+        'page_callback' is called with the area [start, end) of every programmed page once it is done """
     print(f"Will write {len(data) / 1024:.1f} KiB")
 
-    isp_custom_instruction(CI_WRITE_AFTER_WREN, WRSR, 0, 1, 0x00) # Unprotect the flash
-    pages = list(div_to_chunks(data, PAGE_SIZE))
+    write_flash_status(0x00) # Unprotect the flash
+    ranges = [(resume_at, len(data))]
+    if differential:
+        ranges = diff_blocks(data, known=known)
+        changed = sum(end - start for start, end in ranges)
+        print(f"{changed / 1024:.1f} KiB in {len(ranges)} areas changed")
+        for start, end in ranges:
+            if known is not None:
+                blank = len(known) >= end and is_empty_page(known[start:end])
+            else:
+                blank = is_blank(start, end)
+            if not blank:
+                erase_range(start, end)
+
+    def program(ranges, progress_callback=lambda s, e, c: None, page_callback=lambda s, e: None):
+        if flash_chip["program"] != "page":
+            program_aai(data, progress_callback, ranges, page_callback)
+        else:
+            program_pages(data, progress_callback, ranges, pipelined, timed, page_callback)
+
+    if verify_writes:
+        sector = erase_sector_size()
+        for start, end in ranges:
+            unit = start
+            while unit < end:
+                unit_end = min(unit - unit % sector + sector, end)
+                program([(unit, unit_end)], lambda s, e, c: progress_callback(s, e, c) if c < e else None)
+                if not program_verified(data, unit, unit_end, program):
+                    # Carrying on would leave a bad sector behind the ones a resumed session treats as done
+                    raise ValueError(f"Sector {unit:#08x}-{unit_end - 1:#08x} still fails verification "
+                                     f"after {WRITE_RETRIES} rewrites")
+                page_callback(unit, unit_end)
+                unit = unit_end
+        progress_callback(0, len(data), len(data)) # Signal 100% to progress function
+    else:
+        program(ranges, progress_callback, page_callback)
+    write_flash_status(0x1C) # Protect the flash
+    return verify_programmed(data)
+
+def program_verified(data, start, end, program):
+    """ Check the programmed sector [start, end) with on-chip CRCs. Rewrite its failing pages, if that isn't
+        enough erase and program the sector again, up to WRITE_RETRIES times
+        'program' programs the given list of areas of 'data'
+        Returns: True if the sector holds the data """
+    sector_ok = lambda: chip_region_crcs(start, end) == region_crcs(data[start:end])
+    page_size = program_page_size()
+    for attempt in range(WRITE_RETRIES + 1):
+        if attempt:
+            # Bits cleared by mistake need an erase
+            print(f"Rewriting sector {start:#08x}-{end - 1:#08x}")
+            write_retries["sectors"] += 1
+            erase_range(start, end)
+            program([(start, end)])
+        if sector_ok():
+            return True
+
+        # Programming again can clear bits which stayed set, only failing pages are rewritten
+        failed = []
+        for page in range(start, end, page_size):
+            page_end = min(page + page_size, end)
+            if chip_region_crcs(page, page_end) != region_crcs(data[page:page_end]):
+                failed.append((page, page_end))
+        print(f"\nVerification of {start:#08x}-{end - 1:#08x} failed, rewriting {len(failed)} pages")
+        write_retries["pages"] += len(failed)
+        program(failed)
+        if sector_ok():
+            return True
+    return False
+
+def program_pages(data, progress_callback=lambda s, e, c: None, ranges=None, pipelined=False, timed=False,
+                  page_callback=lambda s, e: None):
+    """ Page program the parts of 'data' inside of 'ranges' [(start, end), ...], all of it if None
+        'pipelined' uploads the next page while the previous one is programmed, this needs a controller
+        which latches the page buffer at the start of programming.
+        'timed' waits a page program time calibrated on the first pages instead of polling the busy flag.
+        'page_callback' gets the area [start, end) of every page once it is programmed """
+
+    def wait_programmed():
+        """ Wait until the previous page is programmed, hinting the remaining part of its duration """
+        nonlocal pending
+        if started is not None:
+            elapsed = time.perf_counter() - started
+            if page_time is not None:
+                time.sleep(max(page_time - elapsed, 0))
+            else:
+                poll(lambda: not read_reg (0x6F)[0] & 0x40, "Programming done timeout",
+                     expected=max(flash_chip["t_page_program"] - elapsed, 0), name="page_program")
+        if pending is not None:
+            page_callback(*pending)
+            pending = None
+
+    def program_page(address, page, next_page):
+        """ Start programming 'page', in pipelined mode also upload 'next_page' """
+        wait_programmed()
+        if pipelined:
+            # Start the uploaded page and upload the next one while it is programmed
+            plan = plan_program_page(address, page, upload=reupload)
+            if next_page is not None:
+                plan_program_page(*next_page, start=False, plan=plan)
+            plan.execute()
+        else:
+            plan_program_page(address, page).execute()
+
+    def recovered():
+        nonlocal reupload, started
+        reupload = True # Entering ISP mode again restarted the buffer
+        if started is None: # The failed attempt may have started programming
+            started = time.perf_counter()
+
+    global calibrated_page_time
+    started     = None       # Time the plan starting the last page program finished
+    page_time   = calibrated_page_time if timed else None # Calibrated page program time of the timed mode
+    calibration = []         # Measured page program times
+    reupload    = False      # Pipelined page has to be uploaded again before it is started
+    pending     = None       # Area of the last started page, until it is confirmed by wait_programmed()
+    page_size = program_page_size()
+    pages     = list(div_to_chunks(data, page_size))
+    written   = [(page_n * page_size, page) for page_n, page in enumerate(pages)
+                 if in_ranges(page_n * page_size, ranges)
+                 and not is_empty_page(page)] # If page is filled with 0xFF, then don't write to it
+
+    if pipelined and written:
+        retry("page_program", lambda: plan_program_page(*written[0], start=False).execute())
+    for write_n, (address, page) in enumerate(written):
+        progress_callback(0, len(pages), address // page_size)
+
+        # Programming a page again with the same data leaves it unchanged, so a failed page is simply repeated
+        next_page = written[write_n + 1] if write_n + 1 < len(written) else None
+        retry("page_program", lambda: program_page(address, page, next_page), on_retry=recovered)
+        reupload = False
+        started  = time.perf_counter()
+        pending  = (address, address + len(page))
+
+        if timed and page_time is None:
+            # Measure the page program time by polling without sleeping
+            poll(lambda: not read_reg (0x6F)[0] & 0x40, "Programming done timeout", step=0, name="page_program")
+            calibration.append(time.perf_counter() - started)
+            started = None
+            if len(calibration) == PRGM_CALIBRATION_PAGES:
+                # Median is robust against pages delayed by the host
+                page_time = sorted(calibration)[len(calibration) // 2] * PRGM_TIME_MARGIN
+                calibrated_page_time = page_time
+
+    progress_callback(0, len(data), len(data)) # Signal 100% to progress function
+
+    page_time = None # Always confirm the end of programming on the busy flag
+    wait_programmed()
+
+def program_aai(data, progress_callback=lambda s, e, c: None, ranges=None, page_callback=lambda s, e: None):
+    """ Program the parts of 'data' inside of 'ranges' with SST Auto Address Increment programming
+        A sequence starts with the program engine writing the address and the first word, the following words
+        are custom instructions. Programming a word takes about 10 us, less than writing the registers of the
+        next word over I2C, so the words are sent in plans of AAI_RETRY_WORDS and only their end is polled.
+        A failed plan is programmed again in halves from new sequences, only single words spend the retry budget.
+        'page_callback' gets the area [start, end) of every plan once it is programmed """
+    step      = 2 if flash_chip["program"] == "aai_word" else 1
+    opcode    = PROGRAM_OPCODES[flash_chip["program"]]
+    page_size = program_page_size()
+    pages     = list(div_to_chunks(data, page_size))
+    running   = False # AAI sequence is running, the next word continues at the following address
+
+    def end_sequence():
+        isp_custom_instruction(CI_WRITE, WRDI, 0, 0, 0x00)
+
+    def program_words(address, words):
+        nonlocal running
+        words = list(words)
+        if not running:
+            plan_program_page(address, words.pop(0)).execute()
+            poll(lambda: not read_reg (0x6F)[0] & 0x40, "Programming done timeout",
+                 expected=flash_chip["t_page_program"], name="aai")
+            running = True
+        plan = TransactionPlan()
+        for word in words:
+            plan.write_regs(0x64, word)
+            plan.write_reg(0x61, opcode)
+            plan.write_reg(0x60, (CI_WRITE<<5) | (step<<3) | 1)
+        plan.execute()
+        poll(lambda: not read_reg(0x60)[0] & 0x01, "Custom Instruction Timeout",
+             expected=flash_chip["t_page_program"], name="aai")
+
+    def restart_sequence():
+        """ Position of an interrupted sequence is unknown, the words are programmed again in a new one """
+        nonlocal running
+        end_sequence()
+        running = False
+
+    def recover_sequence():
+        recover_isp()
+        restart_sequence()
+
+    def program_chunk(address, words):
+        """ Program 'words', programming words again with the same data leaves them unchanged """
+        if len(words) == 1:
+            retry("aai_words", lambda: program_words(address, words), on_retry=restart_sequence)
+            return
+        try:
+            program_words(address, words)
+        except OSError:
+            retry_stats["aai_words"] = retry_stats.get("aai_words", 0) + 1
+            time.sleep(retry_backoff)
+            retry("aai_words", recover_sequence, recover=False)
+            half = len(words) // 2
+            program_chunk(address, words[:half])
+            program_chunk(address + half*step, words[half:])
+
+    def skip():
+        """ Skip words by ending the sequence """
+        nonlocal running
+        if running:
+            end_sequence()
+            running = False
+
     for page_n, page in enumerate(pages):
         progress_callback(0, len(pages), page_n)
 
-        if not is_empty_page(page): # If page is filled with 0xFF, then don't write to it
-            poll(lambda: not read_reg (0x6F)[0] & 0x40, "Programming done timeout")
-            # Set write size
-            write_reg(0x71, len(page) - 1)
-            # Set the programming address
-            write_reg(0x64, page_n*PAGE_SIZE >> 16)
-            write_reg(0x65, page_n*PAGE_SIZE >> 8)
-            write_reg(0x66, page_n*PAGE_SIZE)
-            # Write the content to on chip buffer
-            write_reg(0x70, page)
-            # Begin flash programming
-            write_reg(0x6F, 0xA0)
+        if is_empty_page(page):
+            skip()
+            continue
+
+        page  = to_bytes(page) + b"\xFF" * (len(page) % step) # Programming 0xFF leaves the flash unchanged
+        words = list(div_to_chunks(page, step))
+        for word_n in range(0, len(words), AAI_RETRY_WORDS):
+            address = page_n*page_size + word_n*step
+            chunk   = words[word_n:word_n + AAI_RETRY_WORDS]
+            if not in_ranges(address, ranges): # Resumed writes may start inside of a page
+                skip()
+                continue
+            program_chunk(address, chunk)
+            page_callback(address, min(address + len(chunk)*step, len(data)))
 
     progress_callback(0, len(data), len(data)) # Signal 100% to progress function
 
-    poll(lambda: not read_reg (0x6F)[0] & 0x40, "Programming done timeout")
-    isp_custom_instruction(CI_WRITE_AFTER_WREN, WRSR, 0, 1, 0x1C)  # Protect the flash
+    if running:
+        end_sequence()
 
-    data_crc = calculate_crc(data)
-    chip_crc = isp_get_crc(0, len(data) - 1)
+def verify_programmed(data):
+    """ Compare CRC of 'data' with the CRC the controller calculates over the same area """
+    return check_crc(calculate_crc(data), len(data))
+
+def check_crc(data_crc, size):
+    """ Compare 'data_crc' of the first 'size' bytes of the flash with the CRC the controller calculates """
+    chip_crc = isp_get_crc(0, size - 1)
     print(f"File CRC: {data_crc:#04x}")
     print(f"Chip CRC: {chip_crc:#04x}")
     return data_crc == chip_crc
 
-def read_flash(chip_size, progress_callback=lambda s, e, c: None):
+def start_read_stream(address):
+    """ Make the 0x70 port stream the flash from 'address' on """
+    isp_custom_instruction(CI_READ, read_opcode, 3, 3, address)
+    poll(lambda: not read_reg(0x60)[0] & 0x01, "Read Instruction Timeout")
+    if READ_DUMMY_BYTES.get(read_opcode):
+        read_reg(0x70, READ_DUMMY_BYTES[read_opcode]) # Dummy bytes come out of the port first
+
+def find_used_end(size, block_size):
+    """ Binary search the end of the used area in the first 'size' bytes of the flash, in whole blocks """
+    low, high = 0, -(-size // block_size) # Everything from block 'high' on is blank
+    while low < high:
+        middle = (low + high) // 2
+        if is_blank(middle * block_size, size):
+            high = middle
+        else:
+            low = middle + 1
+    return min(low * block_size, size)
+
+def read_flash(chip_size=None, progress_callback=lambda s, e, c: None, sparse=False):
+    """ Read 'chip_size' bytes from the beginning of the flash, the whole flash chip if None
+        See read_flash_pages() for 'sparse' """
+    data = bytearray()
+    for address, page in read_flash_pages(chip_size, progress_callback, sparse):
+        data += page
+    return ( bytes(data), check_crc(calculate_crc(data), len(data)) )
+
+def read_flash_pages(chip_size=None, progress_callback=lambda s, e, c: None, sparse=False, start=0):
+    """ Read 'chip_size' bytes of the flash from 'start' on, up to the end of the flash chip if None
+        Yields (address, b"data") of every page as soon as it is read, without keeping the data.
+        'sparse' skips reading blank erase sectors, found with on-chip CRCs, and yields them filled in.
+        Without 'chip_size' it also searches the end of the used area, everything behind it is only filled in """
+    used_end = chip_size
+    if chip_size is None:
+        chip_size = flash_chip["size"]
     print(f"Will read {chip_size / 1024:.1f} KiB")
-    data = []
 
-    isp_custom_instruction(CI_READ, READ, 3, 3, 0)
-    poll(lambda: not read_reg(0x60)[0] & 0x01, "Read Instruction Timeout")
-    for address in range(0, chip_size, PAGE_SIZE):
-        progress_callback(0, chip_size, address)
-        data += read_reg(0x70, min(chip_size - address, PAGE_SIZE)) # If amount to read is more than PAGE_SIZE byte then read PAGE_SIZE, else read remaining amount
+    def read_page(address, count):
+        """ Read 'count' bytes at 'address', (re)starting the stream there unless it already continues there """
+        nonlocal stream
+        if stream != address:
+            stream = None
+            start_read_stream(address)
+        stream = None # Unknown until the read completes
+        page   = read_reg(0x70, count)
+        stream = address + count
+        return page
 
-    progress_callback(0, chip_size, chip_size) # Signal 100% to progress function
+    block_size = erase_sector_size() if sparse else chip_size
+    if sparse and used_end is None:
+        used_end = find_used_end(chip_size, block_size)
+        print(f"Used area: {used_end / 1024:.1f} KiB")
+    stream = None # Flash address the 0x70 port continues at
+    for block in range(0, chip_size, block_size):
+        block_end = min(block + block_size, chip_size)
+        if block_end <= start:
+            continue
+        if sparse and (used_end is not None and block >= used_end or is_blank(block, block_end)):
+            yield max(block, start), b"\xFF" * (block_end - max(block, start))
+            continue
+        for address in range(max(block, start), block_end, PAGE_SIZE):
+            progress_callback(0, chip_size, address)
+            count = min(block_end - address, PAGE_SIZE) # If amount to read is more than PAGE_SIZE byte then read PAGE_SIZE, else read remaining amount
+            yield address, retry("read_page", lambda: read_page(address, count))
 
-    data_crc = calculate_crc(data)
-    chip_crc = isp_get_crc(0, chip_size - 1)
-    print(f"File CRC: {data_crc:#04x}")
-    print(f"Chip CRC: {chip_crc:#04x}")
-    return ( data, data_crc == chip_crc )
+    progress_callback(0, chip_size, chip_size) # Signal 100% to progress function
 
 
 def get_interface_list():
@@ -245,31 +899,108 @@ def get_device_list(settings=None):
 def start_interface(device, settings=None):
     iface.init_i2c(device, settings)
     enter_isp()
+    iface.tune_i2c(RTD_ISP_ADR)
 
 def setup_flash():
-    flash_id = get_flash_id()
-    print(f"FLASH ID: {flash_id:#04x}")
-    write_reg(0x62, WREN)  # Write Enable opcode
-    write_reg(0x63, EWSR)  # Enable Write Status Register opcode
-    write_reg(0x6A, READ)  # Read opcode
-    write_reg(0x6D, PRGM)  # Program opcode
-    write_reg(0x6E, RDSR)  # Read Status Register opcode
+    global flash_id, flash_chip, read_opcode, calibrated_page_time
+    flash_id    = get_flash_id()
+    flash_chip  = get_flash_chip(flash_id)
+    read_opcode = READ # How the 0x70 port reads is unknown, faster opcodes are only used on request
+    calibrated_page_time = None
+    if flash_chip is DEFAULT_FLASH_CHIP:
+        print(f"FLASH ID: {flash_id:#08x} (Unknown)")
+    else:
+        print(f"FLASH ID: {flash_id:#08x} ({flash_chip['name']}, {flash_chip['size'] // 1024} KiB)")
+    write_regs(0x62, [WREN,   # Write Enable opcode
+                      EWSR])  # Enable Write Status Register opcode
+    write_reg(0x6A, READ)     # Read opcode
+    write_regs(0x6D, [PROGRAM_OPCODES[flash_chip["program"]], # Program opcode
+                      RDSR])  # Read Status Register opcode
+    check_sticky_pointer()
 
 def stop_interface():
     reboot_controller()
     iface.deinit_i2c()
 
 
-def read_flash_file(filename, callback=None):
-    with open(filename, "wb") as fr:
-        buf, crc_ok = read_flash(READ_SIZE, callback)
-        fr.write(bytearray(buf))
-        return crc_ok
+def confirm_resume(done, data):
+    """ Confirm with on-chip CRCs that the flash begins with the 'done' bytes 'data' of an interrupted session
+        Two CRC-8s, like region_crcs(), so a chance match of one doesn't resume on a different flash """
+    if chip_region_crcs(0, done) != region_crcs(data):
+        print("Journal doesn't match the flash, starting from the beginning")
+        return False
+    print(f"Resuming at {done:#08x}")
+    return True
+
+def read_flash_file(filename, callback=None, size=None, sparse=False):
+    """ Read the flash into a file. Pages are written into a memory map of the preallocated file as they arrive
+        and the CRC is calculated along, so memory use doesn't grow with the flash size.
+        Read pages are journaled, an interrupted read of the same flash and size resumes behind the part of the
+        file confirmed by the journal and an on-chip CRC """
+    file_size = size or flash_chip["size"]
+    journal   = Journal(filename, f"read {flash_id:#08x} {file_size:#x}")
+    resume    = bool(journal.entries) and os.path.exists(filename) and os.path.getsize(filename) == file_size
+    done = crc = 0
+    with open(filename, "r+b" if resume else "w+b") as fr:
+        fr.truncate(file_size)
+        with mmap.mmap(fr.fileno(), file_size) as fmap:
+            if resume:
+                done = journal.resume_point(lambda start, end, page_crc: calculate_crc(fmap[start:end]) == page_crc)
+                with memoryview(fmap) as view:
+                    crc = calculate_crc(view[:done])
+                    if done and not confirm_resume(done, view[:done]):
+                        done = crc = 0
+
+            with journal.start(done):
+                for address, page in read_flash_pages(size, callback, sparse, done):
+                    fmap[address:address + len(page)] = page # Reaches the file even if the program dies
+                    crc = calculate_crc(page, crc)
+                    journal.record(address, address + len(page), calculate_crc(page))
+                fmap.flush()
+    return check_crc(crc, file_size)
 
-def write_flash_file(filename, callback=None):
+def write_flash_file(filename, callback=None, erase=False, **options):
+    """ Program the flash from a file, 'options' are passed to program_flash()
+        'erase' erases the flash first unless it is blank. Programmed pages are journaled, an interrupted write
+        of the same file resumes behind the part confirmed by the journal and an on-chip CRC, without erasing """
     with open(filename, "rb") as fw:
-        data = list(fw.read())
-        return program_flash(data, callback)
+        data = fw.read()
+    if options.get("differential"):
+        return program_flash(data, callback, **options) # Rewrites only what differs, nothing to resume
+
+    # The page or verified sector being programmed at the interruption is programmed again, everything behind
+    # it must be blank. Sessions journaling other units don't resume, -V needs to start on a sector boundary
+    unit    = erase_sector_size() if options.get("verify_writes") else program_page_size()
+    journal = Journal(filename, f"write {flash_id:#08x} {len(data):#x} {calculate_crc(data):#04x} {unit:#x}")
+    done    = journal.resume_point(lambda start, end, crc: calculate_crc(data[start:end]) == crc)
+    following = min(done + unit, len(data))
+    if done and following < len(data) and not is_blank(following, len(data)):
+        print("Flash behind the journaled pages isn't blank, starting from the beginning")
+        done = 0
+    if done and not confirm_resume(done, data[:done]):
+        done = 0
+    # Journal of a previous session is replaced before anything is erased
+    with journal.start(done):
+        if erase and not done:
+            # Programming unprotects it again anyway, a blank target area needn't be erased
+            erase_flash(protect=False, blank_size=len(data))
+        return program_flash(data, callback, resume_at=done, **options,
+                             page_callback=lambda start, end: journal.record(start, end, calculate_crc(data[start:end])))
+
+def blank_check_flash(callback=None):
+    print(f"Will blank check {flash_chip['size'] / 1024:.1f} KiB")
+    used = blank_check(progress_callback=callback)
+    for start, end in used:
+        print(f"Not blank: {start:#08x}-{end - 1:#08x}")
+    return not used
+
+def verify_flash_file(filename, callback=None):
+    with open(filename, "rb") as fv:
+        data = fv.read()
+    mismatches = verify_flash(data, progress_callback=callback)
+    for start, end in mismatches:
+        print(f"Mismatch in {start:#08x}-{end - 1:#08x}")
+    return not mismatches
 
 def interface_get_help():
     return iface.HELP_TEXT
@@ -291,12 +1022,33 @@ if __name__ == "__main__":
                         help='select which interface-device to use')
     parser.add_argument('-r', '--read-output', type=str, dest="read_file",
                         help='read flash into this file')
+    parser.add_argument('-b', '--blank-check', action="store_true", dest="blank_check",
+                        help='check whether the flash is blank, using on-chip CRCs')
     parser.add_argument('-e', '--erase', action="store_true", dest="erase",
                         help='erase flash of the controller')
     parser.add_argument('-w', '--write-input', type=str, dest="write_file",
                         help='write flash from this binary file')
+    parser.add_argument('-p', '--pipelined', action="store_true", dest="pipelined",
+                        help='upload the next page while the previous one is programmed')
+    parser.add_argument('-m', '--timed', action="store_true", dest="timed",
+                        help='wait a calibrated page program time instead of polling the busy flag')
+    parser.add_argument('-D', '--differential', action="store_true", dest="differential",
+                        help='only erase and write the sectors that differ from the flash, without chip erase')
+    parser.add_argument('-k', '--known', type=str, dest="known_file",
+                        help='file known to be in the flash, compared instead of on-chip CRCs with -D')
+    parser.add_argument('-v', '--verify', type=str, dest="verify_file",
+                        help='compare flash with this binary file using on-chip CRCs of its blocks')
+    parser.add_argument('-S', '--sparse', action="store_true", dest="sparse",
+                        help='skip reading blank sectors, and the blank end of the flash if no read size is set')
+    parser.add_argument('-V', '--verify-writes', action="store_true", dest="verify_writes",
+                        help='verify every sector with on-chip CRCs while writing, rewrite failed pages and sectors')
     parser.add_argument('-z', '--read-size', type=str, dest="read_size",
-                        help='Set the number of bytes to read from flash')
+                        help='Set the number of bytes to read from flash (default: size of the detected flash chip)')
+    parser.add_argument('-o', '--read-opcode', type=str, dest="read_opcode",
+                        help='SPI opcode to read the flash with, e.g. 0x0b for FAST_READ if the controller streams it '
+                             '(default: 0x03 READ)')
+    parser.add_argument('-R', '--retries', type=int, dest="retries",
+                        help=f'retries of operations failing on the bus, after recovering the controller (default: {RETRY_BUDGET})')
     parser.add_argument('-t', '--trace', action="store_true", dest="trace",
                         help='output full exception trace')
     # TODO: Add read faking, allowing a use of unidirectional interfaces
@@ -339,25 +1091,52 @@ if __name__ == "__main__":
             print(f"Found controller on device {dev_found}!")
             args.dev = str(dev_found)
 
+        if args.retries is not None:
+            retry_budget = args.retries
         start_interface(int(args.dev, 0), args.settings) # Interpret the base from the string
         setup_flash()
 
+        if args.blank_check:
+            print("Flash is blank" if blank_check_flash(lambda s, e, c: progress_bar(c/(e-s))) else "Flash is NOT blank")
+
         if args.erase:
-            erase_flash()
+            # The size of an unknown chip is only a guess, its end may not be blank
+            erase_flash(blank_size=None if flash_chip is DEFAULT_FLASH_CHIP else flash_chip["size"])
 
         if args.write_file:
-            erase_flash()
-            if not write_flash_file(args.write_file, lambda s, e, c: progress_bar(c/(e-s))):
+            known = None
+            if args.known_file:
+                with open(args.known_file, "rb") as fk:
+                    known = fk.read()
+            if not write_flash_file(args.write_file, lambda s, e, c: progress_bar(c/(e-s)), erase=not args.differential,
+                                    pipelined=args.pipelined, timed=args.timed,
+                                    differential=args.differential, known=known,
+                                    verify_writes=args.verify_writes):
                 raise ValueError("CRC MISMATCH DETECTED!!!")
 
+        if args.verify_file:
+            if not verify_flash_file(args.verify_file, lambda s, e, c: progress_bar(c/(e-s))):
+                raise ValueError("VERIFICATION FAILED!!!")
+            print("Verification OK")
+
         if args.read_file:
-            if args.read_size:
-                READ_SIZE = int(args.read_size, 0)
-            else:
-                print(f"WARNING: '-z READ_SIZE' not set, default read amount of {READ_SIZE // 1024} KiB used")
-            if not read_flash_file(args.read_file, lambda s, e, c: progress_bar(c/(e-s))):
+            read_size = int(args.read_size, 0) if args.read_size else None
+            if args.read_opcode:
+                read_opcode = int(args.read_opcode, 0)
+                if read_opcode not in CONTROLLER_READ_OPCODES:
+                    print(f"WARNING: Read opcode {read_opcode:#04x} may not be supported by the controller")
+                elif read_opcode not in flash_chip["read_opcodes"]:
+                    print(f"WARNING: Read opcode {read_opcode:#04x} is not known to be supported by the flash chip")
+            if read_size is None and flash_chip is DEFAULT_FLASH_CHIP:
+                print(f"WARNING: Unknown flash chip and '-z READ_SIZE' not set, default read amount of {READ_SIZE // 1024} KiB used")
+            if not read_flash_file(args.read_file, lambda s, e, c: progress_bar(c/(e-s)), read_size, args.sparse):
                 raise ValueError("CRC MISMATCH DETECTED!!!!")
 
+        if any(write_retries.values()):
+            print(f"Rewritten after failed verification: {write_retries['pages']} pages, "
+                  f"{write_retries['sectors']} sectors")
+        if retry_stats:
+            print("Retries after bus errors: " + ", ".join(f"{name} {n}" for name, n in sorted(retry_stats.items())))
         stop_interface()
     except Exception as e:
         if args.trace or len(str(e)) == 0:
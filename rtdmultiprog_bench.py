@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+
+import sys, os, io, json, time, random, tempfile, contextlib
+import rtdmultiprog
+from misc.flashparams import READ, CONTROLLER_READ_OPCODES
+from misc.journal     import JOURNAL_SUFFIX
+from argparse import ArgumentParser
+
+script_folder = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_INTERFACE = "emulator"
+DEFAULT_SETTINGS  = "-e 500" # Shorter chip erase, the erase phase is dominated by the flash anyway
+DEFAULT_SIZE      = 64 * 2**10
+DEFAULT_BASELINE  = script_folder + os.sep + "rtdmultiprog_bench.json"
+
+# Metrics compared against the baseline, lower is better for all of them. They are counted or modelled by the
+# interface, so they don't depend on the machine; wall time only is compared on request
+COMPARED_METRICS = [ "transactions_per_kib", "bus_time", "retries" ]
+WALL_METRICS     = [ "wall_time" ]
+
+
+def make_image(size, seed=0):
+    """ Firmware-like test image: random data with a blank tail """
+    rnd  = random.Random(seed)
+    used = size * 3 // 4
+    return [rnd.randrange(256) for _ in range(used)] + [0xFF] * (size - used)
+
+def make_update(image):
+    """ Firmware update of 'image' changing a few bytes at its start, middle and end """
+    update = list(image)
+    for address in (0x10, len(image) // 2, len(image) - 0x10):
+        update[address] ^= 0x5A
+    return update
+
+class Interrupted(Exception):
+    """ Simulated interruption of a session, like Ctrl-C or a lost connection """
+
+def interrupt_at(fraction):
+    """ Progress callback interrupting the session once it got through 'fraction' of its work """
+    def callback(start, end, current):
+        if current < end and current >= start + (end - start) * fraction:
+            raise Interrupted()
+    return callback
+
+def resume_check(image):
+    """ Interrupt writing and reading 'image' halfway, then run both again
+        Returns: True if both resumed from their journals and the results match 'image' """
+    def resumed_session(session):
+        """ Run session, return its result and whether it resumed the interrupted one """
+        confirm_resume = rtdmultiprog.confirm_resume
+        confirmed = []
+        rtdmultiprog.confirm_resume = lambda done, data: confirmed.append(confirm_resume(done, data)) or confirmed[-1]
+        try:
+            return session(lambda s, e, c: None), confirmed == [True]
+        finally:
+            rtdmultiprog.confirm_resume = confirm_resume
+
+    ok = True
+    with tempfile.TemporaryDirectory() as folder:
+        image_file = os.path.join(folder, "image.bin")
+        read_file  = os.path.join(folder, "read.bin")
+        with open(image_file, "wb") as fi:
+            fi.write(bytes(image))
+        for session, output in (
+                (lambda callback: rtdmultiprog.write_flash_file(image_file, callback, erase=True), image_file),
+                (lambda callback: rtdmultiprog.read_flash_file(read_file, callback, len(image)), read_file)):
+            try:
+                session(interrupt_at(0.5))
+                return False # Not interrupted, nothing to resume
+            except Interrupted:
+                pass
+            ret, resumed = resumed_session(session)
+            ok = ok and ret and resumed and not os.path.exists(output + JOURNAL_SUFFIX)
+        with open(read_file, "rb") as fr:
+            ok = ok and fr.read() == bytes(image)
+    return ok
+
+def poll_deltas(before, after):
+    """ Polling latency statistics collected between two snapshots of poll_stats """
+    deltas = {}
+    for name, stats in after.items():
+        old    = before.get(name, { "polls": 0, "checks": 0, "total": 0.0 })
+        polls  = stats["polls"] - old["polls"]
+        if polls:
+            total = stats["total"] - old["total"]
+            deltas[name] = {
+                "polls":        polls,
+                "checks":       stats["checks"] - old["checks"],
+                "mean_latency": total / polls,
+                "total_time":   total,
+            }
+    return deltas
+
+def run_phase(name, func, size, results):
+    """ Run one benchmark phase and record its wall time and interface counters """
+    stats = getattr(rtdmultiprog.iface, "stats", None)
+    if stats is not None:
+        rtdmultiprog.iface.reset_stats()
+        stats = rtdmultiprog.iface.stats
+    shadow = dict(rtdmultiprog.shadow_stats)
+    polls  = {name: dict(s) for name, s in rtdmultiprog.poll_stats.items()}
+    retries = dict(rtdmultiprog.retry_stats)
+    start  = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()): # Keep the JSON output clean
+        ret = func()
+    wall = time.perf_counter() - start
+
+    result = {
+        "bytes":     size,
+        "wall_time": wall,
+        "bytes_per_s": size / wall if size else None,
+        "register_writes_skipped": rtdmultiprog.shadow_stats["skipped"] - shadow["skipped"],
+        "polls":     poll_deltas(polls, rtdmultiprog.poll_stats),
+        "retries":   {name: n - retries.get(name, 0) for name, n in rtdmultiprog.retry_stats.items()
+                      if n != retries.get(name, 0)},
+    }
+    if stats is not None:
+        stats = rtdmultiprog.iface.stats
+        result.update({
+            "calls":        stats.get("calls"),
+            "transactions": stats["transactions"],
+            "transactions_per_kib": stats["transactions"] / (size / 1024) if size else None,
+            "bus_time":     stats["bus_time"],
+            "faults":       stats.get("faults", 0),
+            "dropped":      stats.get("dropped", 0),
+            "bus_bytes_per_s": size / stats["bus_time"] if size and stats["bus_time"] else None,
+        })
+    results[name] = result
+    return ret
+
+def run_benchmark(interface, device, settings, size, seed=0, pipelined=False, timed=False):
+    rtdmultiprog.load_interface(interface)
+    image   = make_image(size, seed)
+    results = {}
+
+    run_phase("setup", lambda: (rtdmultiprog.start_interface(device, settings), rtdmultiprog.setup_flash()),
+              0, results)
+    run_phase("erase", rtdmultiprog.erase_flash, 0, results)
+    program_ok = run_phase("program", lambda: rtdmultiprog.program_flash(image, pipelined=pipelined, timed=timed), size, results)
+    read_data, read_ok = run_phase("read", lambda: rtdmultiprog.read_flash(size), size, results)
+    chip_crc = run_phase("crc", lambda: rtdmultiprog.isp_get_crc(0, size - 1), size, results)
+    update   = make_update(image)
+    update_ok = run_phase("update", lambda: rtdmultiprog.program_flash(update, differential=True), size, results)
+    resume_ok = run_phase("resume", lambda: resume_check(make_image(size, seed + 1)), size, results)
+
+    rtdmultiprog.stop_interface()
+
+    # Commands the flash ignored while busy mean the programming mode isn't safe, even if they did no harm
+    dropped = sum(phase.get("dropped", 0) for phase in results.values())
+    return {
+        "interface": interface,
+        "settings":  settings,
+        "size":      size,
+        "program_mode": { "pipelined": pipelined, "timed": timed },
+        "ok":        bool(program_ok and read_ok and list(read_data) == image
+                          and chip_crc == rtdmultiprog.calculate_crc(image) and update_ok and resume_ok
+                          and not dropped),
+        "phases":    results,
+    }
+
+def run_read_opcode_benchmark(interface, device, settings, size=None):
+    """ Read the connected chip with every read opcode it supports, without modifying it
+        Opcodes the controller isn't known to support only report their result and don't affect "ok" """
+    rtdmultiprog.load_interface(interface)
+    results = {}
+
+    run_phase("setup", lambda: (rtdmultiprog.start_interface(device, settings), rtdmultiprog.setup_flash()),
+              0, results)
+    size  = size or rtdmultiprog.flash_chip["size"]
+    reads = {}
+    ok    = True
+    for opcode in rtdmultiprog.flash_chip["read_opcodes"]:
+        rtdmultiprog.read_opcode = opcode
+        data, crc_ok = run_phase(f"read_{opcode:#04x}", lambda: rtdmultiprog.read_flash(size), size, results)
+        results[f"read_{opcode:#04x}"]["crc_ok"] = crc_ok
+        if opcode in CONTROLLER_READ_OPCODES:
+            reads[opcode] = data
+            ok = ok and crc_ok
+    rtdmultiprog.read_opcode = READ
+
+    rtdmultiprog.stop_interface()
+
+    return {
+        "interface": interface,
+        "settings":  settings,
+        "size":      size,
+        "chip":      rtdmultiprog.flash_chip["name"],
+        "ok":        ok and all(data == reads[READ] for data in reads.values()),
+        "phases":    results,
+    }
+
+def metric_value(phase, metric):
+    """ Value of 'metric' in the 'phase' result, retries are summed over the operations """
+    value = phase.get(metric)
+    if metric == "retries" and value is not None:
+        return sum(value.values())
+    return value
+
+def compare(result, baseline, tolerance, wall_tolerance=None):
+    """ Return list of regressions of 'result' against 'baseline', wall time only with 'wall_tolerance' """
+    regressions = []
+    metrics = COMPARED_METRICS + (WALL_METRICS if wall_tolerance is not None else [])
+    for phase, base in baseline["phases"].items():
+        if phase not in result["phases"]:
+            continue
+        for metric in metrics:
+            old = metric_value(base, metric)
+            new = metric_value(result["phases"][phase], metric)
+            if old is None or new is None:
+                continue
+            tol = wall_tolerance if metric in WALL_METRICS else tolerance
+            if new > old * (1 + tol):
+                change = f" ({new / old - 1:+.1%})" if old else ""
+                regressions.append(f"{phase}.{metric}: {old:.6g} -> {new:.6g}{change}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Non-interactive throughput benchmark of the flash operations.")
+    parser.add_argument('-i', '--interface', type=str, default=DEFAULT_INTERFACE,
+                        help=f'programming interface to benchmark (default: {DEFAULT_INTERFACE})')
+    parser.add_argument('-d', '--device', type=lambda s: int(s, 0), default=0,
+                        help='interface-device to use (default: 0)')
+    parser.add_argument('-s', '--settings', type=str, default=DEFAULT_SETTINGS,
+                        help=f'interface settings (default: "{DEFAULT_SETTINGS}")')
+    parser.add_argument('-z', '--size', type=lambda s: int(s, 0),
+                        help=f'number of bytes to program and read (default: {DEFAULT_SIZE}, chip size with -r)')
+    parser.add_argument('-p', '--pipelined', action="store_true",
+                        help='program pages pipelined')
+    parser.add_argument('-m', '--timed', action="store_true",
+                        help='program pages with a calibrated page program time instead of polling')
+    parser.add_argument('-r', '--read-opcodes', action="store_true",
+                        help='only compare reading the connected chip with each of its read opcodes, without writing it')
+    parser.add_argument('-b', '--baseline', type=str, default=DEFAULT_BASELINE,
+                        help='baseline JSON file to compare against')
+    parser.add_argument('-u', '--update-baseline', action="store_true",
+                        help='store the result as the new baseline')
+    parser.add_argument('-o', '--output', type=str,
+                        help='also write the JSON result into this file')
+    parser.add_argument('--tolerance', type=float, default=0.05,
+                        help='allowed relative increase of bus metrics (default: 0.05)')
+    parser.add_argument('-W', '--wall-time', action="store_true",
+                        help='also compare wall times, which depend on the machine and its load')
+    parser.add_argument('--wall-tolerance', type=float, default=0.5,
+                        help='allowed relative increase of wall time with -W (default: 0.5)')
+    parser.add_argument('--destructive', action="store_true",
+                        help='allow erasing and rewriting the flash on an interface other than the emulator')
+    args = parser.parse_args()
+
+    if not args.read_opcodes and args.interface != DEFAULT_INTERFACE and not args.destructive:
+        print(f"The benchmark erases and rewrites the whole flash, which destroys the firmware of a real board.\n"
+              f"Use --destructive to run it on \"{args.interface}\" anyway, or -r to only read.", file=sys.stderr)
+        exit(2)
+
+    if args.read_opcodes:
+        result = run_read_opcode_benchmark(args.interface, args.device, args.settings, args.size)
+    else:
+        result = run_benchmark(args.interface, args.device, args.settings, args.size or DEFAULT_SIZE,
+                               pipelined=args.pipelined, timed=args.timed)
+
+    regressions = []
+    if args.read_opcodes:
+        pass # Not comparable with the baseline
+    elif args.update_baseline:
+        with open(args.baseline, "w") as fb:
+            json.dump(result, fb, indent=2)
+            fb.write("\n")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, "r") as fb:
+            baseline = json.load(fb)
+        if (baseline["interface"], baseline["settings"], baseline["size"], baseline.get("program_mode")) != \
+           (result["interface"], result["settings"], result["size"], result["program_mode"]):
+            print("WARNING: baseline was recorded with different parameters", file=sys.stderr)
+        regressions = compare(result, baseline, args.tolerance, args.wall_tolerance if args.wall_time else None)
+        result["regressions"] = regressions
+
+    output = json.dumps(result, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as fo:
+            fo.write(output + "\n")
+
+    if not result["ok"]:
+        print("Benchmark data mismatch!", file=sys.stderr)
+        exit(1)
+    if regressions:
+        print("Regressions against baseline:\n  " + "\n  ".join(regressions), file=sys.stderr)
+        exit(1)
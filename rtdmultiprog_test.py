@@ -103,11 +103,11 @@ def test_device(dev):
         # print(f"{Color.green}success{Color.white}")
         
         print("Write I2C test... ", end='')
-        rtdmultiprog.iface.write_i2c(RIGHT_ADDRESS, [0x6F, 0x80])
+        rtdmultiprog.iface.write_i2c(RIGHT_ADDRESS, rtdmultiprog.iface_data(b"\x6F\x80"))
         print(f"{Color.green}success{Color.white}")
         input()
         print("Read I2C test... ", end='')
-        rtdmultiprog.iface.write_i2c(RIGHT_ADDRESS, [0x6F])
+        rtdmultiprog.iface.write_i2c(RIGHT_ADDRESS, rtdmultiprog.iface_data(b"\x6F"))
         recv = rtdmultiprog.iface.read_i2c(RIGHT_ADDRESS, 1)[0]
         if not rtdmultiprog.iface.read_i2c(RIGHT_ADDRESS, 1)[0] & 0x80:
             raise Exception(f"Write failed to set bit or Read failed to get bit. Sent: 0x80, Received: {recv:#04x}")